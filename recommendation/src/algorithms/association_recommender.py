@@ -1,23 +1,37 @@
 from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set
 
 import numpy as np
+import pandas as pd
 from mlxtend.frequent_patterns import apriori, association_rules
+from scipy import sparse
 from src.algorithms.base_recommender import BaseRecommender
 from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import rating_matrix, recent_items
+from src.models.recent_interactions import load_or_build_store
+from src.models.topk import select_top_k, to_user2items
 
 
 class AssociationRecommender(BaseRecommender):
+    supports_fold_in = True
+
     def __init__(
         self,
         num_users: int = 1000,
         num_test_items: int = 5,
         data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
     ):
         super().__init__(
             num_users=num_users,
             num_test_items=num_test_items,
             data_path=data_path,
+            memory_budget=memory_budget,
         )
+        self.rule_item_ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self.antecedents: sparse.csr_matrix = None
+        self.consequents: sparse.csr_matrix = None
+        self.lifts: np.ndarray = np.empty(0, dtype=np.float32)
         np.random.seed(0)
         self.logger.info("initialized association recommender")
 
@@ -29,15 +43,27 @@ class AssociationRecommender(BaseRecommender):
         min_support = kwargs.get("min_support", 0.1)
         min_threshold = kwargs.get("min_threshold", 1)
 
-        user_movie_matrix = dataset.train.pivot(
-            index="user_id",
-            columns="movie_id",
-            values="rating",
-        )
+        sparse_movie_ids: Optional[np.ndarray] = None
+        if self.memory_budget.limit is None:
+            user_movie_matrix = dataset.train.pivot(
+                index="user_id",
+                columns="movie_id",
+                values="rating",
+            )
 
-        user_movie_matrix[user_movie_matrix < 4] = 0
-        user_movie_matrix[user_movie_matrix.isnull()] = 0
-        user_movie_matrix[user_movie_matrix >= 4] = 1
+            user_movie_matrix[user_movie_matrix < 4] = 0
+            user_movie_matrix[user_movie_matrix.isnull()] = 0
+            user_movie_matrix[user_movie_matrix >= 4] = 1
+        else:
+            # a sparse boolean frame instead of the dense users x movies pivot
+            # sparse frames need positional column names, mapped back to movie ids after mining
+            user_ids = np.sort(dataset.train.user_id.unique())
+            sparse_movie_ids = np.sort(dataset.train.movie_id.unique())
+            high_rating = dataset.train[dataset.train.rating >= 4]
+            user_movie_matrix = pd.DataFrame.sparse.from_spmatrix(
+                rating_matrix(high_rating, user_ids, sparse_movie_ids, values=np.ones(len(high_rating))).astype(bool),
+                index=user_ids,
+            )
 
         freq_movies = apriori(
             user_movie_matrix,
@@ -50,6 +76,32 @@ class AssociationRecommender(BaseRecommender):
             metric="lift",
             min_threshold=min_threshold,
         )
+        if sparse_movie_ids is not None:
+            for column in ["antecedents", "consequents"]:
+                self.rules[column] = self.rules[column].apply(
+                    lambda movies: frozenset(int(sparse_movie_ids[i]) for i in movies)  # type: ignore
+                )
+        self.index_rules()
+
+    def index_rules(self):
+        """rule x movie matrices of the antecedents and consequents of self.rules, for matching users in batches."""
+        self.rule_item_ids = np.sort(
+            np.array(
+                list({int(movie) for movies in [*self.rules.antecedents, *self.rules.consequents] for movie in movies}),
+                dtype=np.int64,
+            )
+        )
+        self.antecedents = self._rule_matrix(self.rules.antecedents)
+        self.consequents = self._rule_matrix(self.rules.consequents)
+        self.lifts = self.rules.lift.values.astype(np.float32)
+
+    def _rule_matrix(self, itemsets: pd.Series) -> sparse.csr_matrix:
+        rows = np.repeat(np.arange(len(itemsets)), [len(movies) for movies in itemsets])
+        movie_ids = np.array([int(movie) for movies in itemsets for movie in movies], dtype=np.int64)
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, np.searchsorted(self.rule_item_ids, movie_ids))),
+            shape=(len(itemsets), len(self.rule_item_ids)),
+        )
 
     def recommend(
         self,
@@ -57,29 +109,37 @@ class AssociationRecommender(BaseRecommender):
         **kwargs,
     ) -> RecommendResult:
         self.logger.info("start recommendation")
+        top_k = kwargs.get("top_k", 10)
+        recent_store_path = kwargs.get("recent_store_path", None)
+
         self.train(
             dataset=dataset,
             **kwargs,
         )
 
-        pred_user2items = defaultdict(list)
-        user_evaluated_movies = dataset.train.groupby("user_id").agg({"movie_id": list})["movie_id"].to_dict()
-
-        movielens_train_high_rating = dataset.train[dataset.train.rating >= 4]
+        store = load_or_build_store(
+            dataset.train,
+            capacity=kwargs.get("num_recent", 5),
+            path=recent_store_path,
+        )
+        self.logger.info(f"recent interactions of {store.num_users} users")
 
-        for user_id, data in movielens_train_high_rating.groupby("user_id"):
-            input_data = data.sort_values("timestamp")["movie_id"].tolist()[-5:]
-            matched_flags = self.rules.antecedents.apply(lambda x: len(set(input_data) & x)) >= 1
+        user_ids = np.sort(dataset.train.user_id.unique())
+        movie_ids = np.sort(dataset.train.movie_id.unique())
+        mask, excluded = self.candidate_filters(
+            dataset, user_ids, movie_ids, rating_matrix(dataset.train, user_ids, movie_ids), **kwargs
+        )
+        candidate_movie_ids = set(movie_ids[mask].tolist()) if mask is not None else None
 
-            consequent_movies = []
-            for i, row in self.rules[matched_flags].sort_values("lift", ascending=False).iterrows():
-                consequent_movies.extend(row["consequents"])
-            counter = Counter(consequent_movies)
-            for movie_id, movie_cnt in counter.most_common():
-                if movie_id not in user_evaluated_movies[user_id]:
-                    pred_user2items[user_id].append(movie_id)
-                if len(pred_user2items[user_id]) == 10:
-                    break
+        pred_user2items: Dict[int, List[int]] = defaultdict(list)
+        for user_id in store.user_ids[: store.num_users].tolist():
+            i = np.searchsorted(user_ids, user_id)
+            pred_user2items[user_id] = self.recommend_recent(
+                recent_movie_ids=store.recent(user_id),
+                evaluated_movie_ids=movie_ids[excluded.indices[excluded.indptr[i] : excluded.indptr[i + 1]]].tolist(),
+                top_k=top_k,
+                candidate_movie_ids=candidate_movie_ids,
+            )
 
         recommendation = RecommendResult(
             rating=dataset.test.rating,
@@ -87,3 +147,68 @@ class AssociationRecommender(BaseRecommender):
         )
         self.logger.info("done recommendation")
         return recommendation
+
+    def _fold_in(
+        self,
+        ratings: pd.DataFrame,
+        top_k: int,
+        dataset: Optional[Dataset],
+        **kwargs,
+    ) -> Dict[int, List[int]]:
+        """
+        match the new users' recent high-rated movies against every rule at once. Like recommend_recent, movies are
+        ranked by the number of matching rules recommending them; ties go to the higher mean lift of those rules.
+        """
+        user_ids = np.sort(ratings.user_id.unique())
+        if len(self.rules) == 0:
+            return {int(user_id): [] for user_id in user_ids}
+        recent = recent_items(ratings, num_recent=kwargs.get("num_recent", 5))
+        recent = recent[recent.movie_id.isin(self.rule_item_ids)]
+        user_recent_matrix = rating_matrix(recent, user_ids, self.rule_item_ids, values=np.ones(len(recent)))
+        matched = ((user_recent_matrix @ self.antecedents.T) > 0).astype(np.float32)
+        counts = (matched @ self.consequents).toarray()
+        lift_sums = (matched @ sparse.diags(self.lifts) @ self.consequents).toarray()
+        mean_lifts = lift_sums / np.maximum(counts, 1)
+        scores = np.where(counts > 0, counts + mean_lifts / (2 * max(self.lifts.max(initial=0), 1e-12)), -np.inf)
+        mask, excluded = self.candidate_filters(
+            dataset,
+            user_ids,
+            self.rule_item_ids,
+            rating_matrix(ratings[ratings.movie_id.isin(self.rule_item_ids)], user_ids, self.rule_item_ids),
+            **kwargs,
+        )
+        indexes, top_scores = select_top_k(
+            scores,
+            k=top_k,
+            exclude=excluded,
+            mask=mask,
+        )
+        return to_user2items(user_ids, self.rule_item_ids, indexes, top_scores)
+
+    def recommend_recent(
+        self,
+        recent_movie_ids: np.ndarray,
+        evaluated_movie_ids: Iterable[int],
+        top_k: int = 10,
+        candidate_movie_ids: Optional[Set[int]] = None,
+    ) -> List[int]:
+        """
+        consequents of the rules matching any recent movie, most frequent first; usable per request.
+        only movies in candidate_movie_ids are recommended when given.
+        """
+        input_data = set(recent_movie_ids.tolist())
+        matched_flags = self.rules.antecedents.apply(lambda x: len(input_data & x)) >= 1
+
+        consequent_movies = []
+        for i, row in self.rules[matched_flags].sort_values("lift", ascending=False).iterrows():
+            consequent_movies.extend(row["consequents"])
+        counter = Counter(consequent_movies)
+
+        evaluated = set(evaluated_movie_ids)
+        pred_items: List[int] = []
+        for movie_id, movie_cnt in counter.most_common():
+            if movie_id not in evaluated and (candidate_movie_ids is None or movie_id in candidate_movie_ids):
+                pred_items.append(movie_id)
+            if len(pred_items) == top_k:
+                break
+        return pred_items
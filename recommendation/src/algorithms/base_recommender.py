@@ -1,27 +1,56 @@
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
 
+import numpy as np
+import pandas as pd
+from scipy import sparse
 from src.models.dataset import DataLoader, Dataset, RecommendResult
-from src.models.metrics import MetricCalculator
+from src.models.interactions import ratings_fingerprint
+from src.models.item_filters import ItemFilter, exclusion_matrix
+from src.models.metrics import MetricCalculator, Metrics, RankingAccumulator, SampledEvaluation
+from src.models.recommendation_cache import RecommendationCache
 from src.utils.logger import configure_logger
+from src.utils.memory import MemoryBudget, peak_rss
+
+# recommend kwargs left out of the model version: execution settings that do not change any list,
+# and the filters, which are part of the cache key instead
+_UNVERSIONED_KWARGS = frozenset(
+    {"top_k", "num_workers", "num_threads", "n_jobs", "onnx_threads", "block_size"}
+    | {"neighbor_path", "recent_store_path", "onnx_path"}
+    | {"item_filter", "user_exclusions"}
+)
 
 
 class BaseRecommender(ABC):
+    # whether fold_in can serve new and updated users from the last trained model
+    supports_fold_in = False
+
     def __init__(
         self,
         num_users: int = 1000,
         num_test_items: int = 5,
         data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
     ):
         self.logger = configure_logger(__name__)
         self.num_users = num_users
         self.num_test_items = num_test_items
         self.data_path = data_path
+        self.memory_budget = MemoryBudget(memory_budget)
         self.data_loader = DataLoader(
             num_users=self.num_users,
             num_test_items=self.num_test_items,
             data_path=self.data_path,
+            memory_budget=self.memory_budget,
         )
         self.metric_calculator = MetricCalculator()
+        self.recommendation_cache: Optional[RecommendationCache] = None
+        self.model_version: Hashable = 0
+        # when set, top k lists are computed shard_size users at a time and every shard is passed to on_top_k
+        self.on_top_k: Optional[Callable[[Dict[int, List[int]]], None]] = None
+        self.shard_size = 256
         self.logger.info("initialized base recommender")
 
     @abstractmethod
@@ -40,28 +69,315 @@ class BaseRecommender(ABC):
     ) -> RecommendResult:
         raise NotImplementedError
 
-    def run_sample(
+    def attach_cache(self, recommendation_cache: Optional[RecommendationCache]):
+        """serve top k lists from recommendation_cache from now on; None detaches it."""
+        self.recommendation_cache = recommendation_cache
+
+    def model_fingerprint(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ) -> str:
+        """version of the model train builds from dataset and kwargs: the training ratings, algorithm and params."""
+        params = sorted((name, repr(value)) for name, value in kwargs.items() if name not in _UNVERSIONED_KWARGS)
+        return ratings_fingerprint(dataset.train, type(self).__name__, params)
+
+    def update_model_version(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ):
+        """called by train, so lists cached for other data or params are never served; free without a cache."""
+        if self.recommendation_cache is not None:
+            self.set_model_version(self.model_fingerprint(dataset, **kwargs))
+
+    def cache_filters(self, **kwargs) -> Callable[[int], Hashable]:
+        """
+        the part of each user's cache key set by kwargs["item_filter"] and that user's own kwargs["user_exclusions"],
+        so changing one user's exclusions only misses that user's list.
+        """
+        item_filter: Optional[ItemFilter] = kwargs.get("item_filter", None)
+        if item_filter is not None and item_filter.is_empty():
+            item_filter = None
+        user_exclusions: Dict[int, List[int]] = kwargs.get("user_exclusions", None) or {}
+        return lambda user_id: (item_filter, tuple(user_exclusions.get(user_id, ())))
+
+    def recommend_top_k(
+        self,
+        dataset: Dataset,
+        top_k: int = 10,
+        **kwargs,
+    ) -> Dict[int, List[int]]:
+        """
+        top k lists of every training user. When recommendation_cache holds all of them for the model dataset and
+        kwargs would train, they are served without training; otherwise recommend runs and fills the cache.
+        """
+        user_ids = np.sort(dataset.train.user_id.unique()).tolist()
+        if self.recommendation_cache is not None:
+            model_version = self.model_fingerprint(dataset, **kwargs)
+            filters = self.cache_filters(**kwargs)
+            cached: Dict[int, List[int]] = {}
+            for user_id in user_ids:
+                items = self.recommendation_cache.get(model_version, user_id, top_k, filters(user_id))
+                if items is None:
+                    break
+                cached[user_id] = items
+            else:
+                self.logger.info(f"{len(cached)} top {top_k} lists served from the cache without training")
+                return cached
+        user2items = self.recommend(dataset, top_k=top_k, **kwargs).user2items
+        return {user_id: user2items.get(user_id, []) for user_id in user_ids}
+
+    def cached_top_k(
+        self,
+        user_ids: np.ndarray,
+        k: int,
+        compute: Callable[[np.ndarray], Dict[int, List[int]]],
+        filters: Callable[[int], Hashable] = lambda user_id: (),
+    ) -> Dict[int, List[int]]:
+        """
+        top k lists of user_ids, served from recommendation_cache where possible; filters gives each user's
+        filter part of the key. compute is called once with the user ids that missed and must return their lists.
+        """
+        if self.recommendation_cache is None:
+            return self._compute_shards(user_ids, compute)
+
+        user2items: Dict[int, List[int]] = {}
+        missing = []
+        for user_id in user_ids.tolist():
+            items = self.recommendation_cache.get(self.model_version, user_id, k, filters(user_id))
+            if items is None:
+                missing.append(user_id)
+            else:
+                user2items[user_id] = items
+        if missing:
+            computed = self._compute_shards(np.array(missing, dtype=user_ids.dtype), compute)
+            for user_id in missing:
+                user2items[user_id] = computed.get(user_id, [])
+                self.recommendation_cache.put(self.model_version, user_id, k, user2items[user_id], filters(user_id))
+        self.logger.info(f"top {k} lists: {len(user_ids) - len(missing)} cached, {len(missing)} computed")
+        return user2items
+
+    def _compute_shards(
         self,
+        user_ids: np.ndarray,
+        compute: Callable[[np.ndarray], Dict[int, List[int]]],
+    ) -> Dict[int, List[int]]:
+        if self.on_top_k is None:
+            return compute(user_ids)
+        user2items: Dict[int, List[int]] = {}
+        for start in range(0, len(user_ids), self.shard_size):
+            shard = compute(user_ids[start : start + self.shard_size])
+            self.on_top_k(shard)
+            user2items.update(shard)
+        return user2items
+
+    def candidate_filters(
+        self,
+        dataset: Optional[Dataset],
+        user_ids: np.ndarray,
+        item_ids: np.ndarray,
+        rated: sparse.csr_matrix,
+        **kwargs,
+    ) -> Tuple[Optional[np.ndarray], sparse.csr_matrix]:
+        """
+        item mask of kwargs["item_filter"] (None when there is no filter) and the user x item matrix to exclude:
+        rated items plus kwargs["user_exclusions"]. Both are applied inside select_top_k.
+        The item filter is evaluated on the item content of dataset, so it needs one.
+        """
+        item_filter: Optional[ItemFilter] = kwargs.get("item_filter", None)
+        user_exclusions: Optional[Dict[int, List[int]]] = kwargs.get("user_exclusions", None)
+        mask = None
+        if item_filter is not None and not item_filter.is_empty():
+            if dataset is None:
+                raise ValueError(f"{item_filter} needs a dataset with the item content")
+            mask = dataset.item_bitmaps.mask(item_filter, item_ids)
+            self.logger.info(f"{mask.sum()} of {len(item_ids)} items pass {item_filter}")
+        if user_exclusions:
+            rated = (rated + exclusion_matrix(user_ids, item_ids, user_exclusions)).tocsr()
+        return mask, rated
+
+    def fold_in(
+        self,
+        ratings: pd.DataFrame,
+        top_k: int = 10,
+        dataset: Optional[Dataset] = None,
+        **kwargs,
+    ) -> Dict[int, List[int]]:
+        """
+        top k lists of the users in ratings (user_id, movie_id, rating and optionally timestamp) against the model
+        of the last train, without retraining. ratings hold the whole history of each user, so new users are served
+        immediately and updated users replace their old lists; movies unknown to the model are ignored.
+        kwargs["item_filter"] and kwargs["user_exclusions"] apply as in recommend; an item filter needs dataset.
+        Only for recommenders with supports_fold_in.
+        """
+        if not self.supports_fold_in:
+            raise NotImplementedError(f"{type(self).__name__} does not support fold-in; check supports_fold_in")
+        started = time.perf_counter()
+        if "timestamp" not in ratings.columns:
+            # without timestamps, rows are taken to be in time order
+            ratings = ratings.assign(timestamp=np.arange(len(ratings)))
+        user2items = self._fold_in(ratings, top_k, dataset, **kwargs)
+        self.invalidate_users(user2items)
+        elapsed_ms = 1000 * (time.perf_counter() - started)
+        self.logger.info(f"folded in {len(user2items)} users in {elapsed_ms:.1f} ms")
+        return user2items
+
+    def _fold_in(
+        self,
+        ratings: pd.DataFrame,
+        top_k: int,
+        dataset: Optional[Dataset],
+        **kwargs,
+    ) -> Dict[int, List[int]]:
+        raise NotImplementedError(f"{type(self).__name__} does not support fold-in")
+
+    def check_fold_in(
+        self,
+        dataset: Dataset,
+        num_users: int = 50,
+        top_k: int = 10,
+        **kwargs,
+    ) -> List[int]:
+        """
+        recommend on dataset, then fold the training ratings of num_users users back in. Both see the same model,
+        so their lists should agree; returns the users whose fold-in top k holds other items (ties may reorder).
+        """
+        if not self.supports_fold_in:
+            raise NotImplementedError(f"{type(self).__name__} does not support fold-in; check supports_fold_in")
+        recommended = self.recommend(dataset, top_k=top_k, **kwargs).user2items
+        user_ids = np.sort(dataset.train.user_id.unique())[:num_users].tolist()
+        folded = self.fold_in(
+            dataset.train[dataset.train.user_id.isin(user_ids)],
+            top_k=top_k,
+            dataset=dataset,
+            **kwargs,
+        )
+        identical = sum(folded.get(user_id, []) == recommended.get(user_id, []) for user_id in user_ids)
+        different = [
+            user_id for user_id in user_ids if set(folded.get(user_id, [])) != set(recommended.get(user_id, []))
+        ]
+        self.logger.info(
+            f"fold-in of {len(user_ids)} training users: {identical} identical, "
+            f"{len(user_ids) - identical - len(different)} reordered, {len(different)} different"
+        )
+        return different
+
+    def invalidate_users(self, user_ids: Iterable[int]):
+        """forget cached lists of users whose ratings changed."""
+        if self.recommendation_cache is not None:
+            self.recommendation_cache.invalidate_users(user_ids)
+
+    def set_model_version(self, model_version: Hashable):
+        """switch to a new model artifact; lists cached for the previous version are dropped."""
+        if self.recommendation_cache is not None and model_version != self.model_version:
+            self.recommendation_cache.invalidate_model(self.model_version)
+        self.model_version = model_version
+
+    def evaluate(
+        self,
+        dataset: Dataset,
         k: int = 10,
+        num_workers: int = 1,
         **kwargs,
-    ) -> None:
-        movielens = self.data_loader.load()
+    ) -> Metrics:
+        """with num_workers > 1, shards of top k lists are evaluated on worker threads while later shards are scored."""
+        if num_workers > 1:
+            return self._evaluate_pipelined(dataset, k, num_workers, **kwargs)
         recommend_result = self.recommend(
-            dataset=movielens,
+            dataset=dataset,
             **kwargs,
         )
-        metrics = self.metric_calculator.calculate(
-            true_rating=movielens.test.rating.tolist(),
+        return self.metric_calculator.calculate(
+            true_rating=dataset.test.rating.tolist(),
             pred_rating=recommend_result.rating.tolist(),
-            true_user2items=movielens.test_user2items,
+            true_user2items=dataset.test_user2items,
             pred_user2items=recommend_result.user2items,
             k=k,
         )
-        self.logger.info(
-            f"""
+
+    def _evaluate_pipelined(
+        self,
+        dataset: Dataset,
+        k: int,
+        num_workers: int,
+        **kwargs,
+    ) -> Metrics:
+        accumulator = RankingAccumulator(dataset.test_user2items, k)
+        shards: List[Future] = []
+        with ThreadPoolExecutor(max_workers=num_workers - 1) as executor:
+            self.on_top_k = lambda user2items: shards.append(executor.submit(accumulator.add, user2items))
+            try:
+                recommend_result = self.recommend(
+                    dataset=dataset,
+                    **kwargs,
+                )
+            finally:
+                self.on_top_k = None
+            for shard in shards:
+                shard.result()
+        self.logger.info(f"{len(accumulator.evaluated)} users evaluated in {len(shards)} shards while scoring")
+
+        # lists not computed through cached_top_k (and cache hits) are evaluated now
+        accumulator.add({user_id: recommend_result.user2items.get(user_id, []) for user_id in accumulator.remaining()})
+        return Metrics(
+            rmse=self.metric_calculator.calculate_rmse(
+                true_rating=dataset.test.rating.tolist(),
+                pred_rating=recommend_result.rating.tolist(),
+            ),
+            precision_at_k=accumulator.precision_at_k(),
+            recall_at_k=accumulator.recall_at_k(),
+        )
+
+    def run_sample(
+        self,
+        k: int = 10,
+        evaluation: Optional[SampledEvaluation] = None,
+        num_workers: int = 1,
+        **kwargs,
+    ) -> None:
+        """num_workers > 1 overlaps the stages of loading, and scoring with evaluation; see DataLoader.load and evaluate."""
+        movielens = self.data_loader.load(num_workers=num_workers)
+        if evaluation is None:
+            metrics = self.evaluate(
+                dataset=movielens,
+                k=k,
+                num_workers=num_workers,
+                **kwargs,
+            )
+            self.logger.info(
+                f"""
 RESULT:
     RMSE: {metrics.rmse:.3f}
     PRECISION@{k}: {metrics.precision_at_k.precision:.3f}
     RECALL@{k}: {metrics.recall_at_k.recall:.3f}
         """
-        )
+            )
+        else:
+            recommend_result = self.recommend(
+                dataset=movielens,
+                **kwargs,
+            )
+            sampled = self.metric_calculator.calculate_sampled(
+                true_rating=movielens.test.rating.tolist(),
+                pred_rating=recommend_result.rating.tolist(),
+                rating_user_ids=movielens.test.user_id.tolist(),
+                true_user2items=movielens.test_user2items,
+                pred_user2items=recommend_result.user2items,
+                k=k,
+                evaluation=evaluation,
+                user_activity=movielens.user_stats["count"].to_dict(),
+            )
+            level = f"{evaluation.confidence:.0%}"
+            self.logger.info(
+                f"""
+RESULT ({sampled.num_sampled_users} of {sampled.num_users} users, {level} confidence intervals):
+    RMSE: {sampled.metrics.rmse:.3f} [{sampled.rmse_ci.low:.3f}, {sampled.rmse_ci.high:.3f}]
+    PRECISION@{k}: {sampled.metrics.precision_at_k.precision:.3f} [{sampled.precision_ci.low:.3f}, {sampled.precision_ci.high:.3f}]
+    RECALL@{k}: {sampled.metrics.recall_at_k.recall:.3f} [{sampled.recall_ci.low:.3f}, {sampled.recall_ci.high:.3f}]
+        """
+            )
+        if self.recommendation_cache is not None:
+            self.logger.info(f"recommendation cache: {self.recommendation_cache.stats}")
+        self.memory_budget.close()
+        self.logger.info(f"peak RSS: {peak_rss() / 1024 ** 2:.1f} MiB")
@@ -0,0 +1,197 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from src.algorithms.base_recommender import BaseRecommender
+from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import rating_matrix, recent_items
+from src.models.neighbors import top_n_cosine_neighbors
+from src.models.recent_interactions import RecentInteractionStore, load_or_build_store
+from src.models.topk import select_top_k, to_user2items
+
+
+class ContentBasedRecommender(BaseRecommender):
+    supports_fold_in = True
+
+    def __init__(
+        self,
+        num_users: int = 1000,
+        num_test_items: int = 5,
+        data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
+    ):
+        super().__init__(
+            num_users=num_users,
+            num_test_items=num_test_items,
+            data_path=data_path,
+            memory_budget=memory_budget,
+        )
+        self.item_ids: np.ndarray = np.empty(0, dtype=np.int32)
+        self.neighbors: sparse.csr_matrix = None
+        self.prior: np.ndarray = np.empty(0, dtype=np.float32)
+        np.random.seed(0)
+        self.logger.info("initialized content based recommender")
+
+    def train(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ):
+        self.update_model_version(dataset, **kwargs)
+        num_neighbors = kwargs.get("num_neighbors", 100)
+        block_size = self.memory_budget.block_rows(
+            bytes_per_row=16 * len(dataset.item_content),
+            default=kwargs.get("block_size", 1024),
+        )
+
+        self.item_ids = dataset.item_content.movie_id.values
+        self.neighbors = top_n_cosine_neighbors(
+            features=dataset.content_features.matrix,
+            num_neighbors=num_neighbors,
+            block_size=block_size,
+        )
+        self.logger.info(f"item neighbors: {self.neighbors.shape} with {self.neighbors.nnz} similarities")
+        # recommend replaces this with the popularity prior of the users it scores
+        self.prior = np.zeros(len(self.item_ids), dtype=np.float32)
+
+    def recommend(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ) -> RecommendResult:
+        self.logger.info("start recommendation")
+
+        top_k = kwargs.get("top_k", 10)
+        num_recent = kwargs.get("num_recent", 5)
+
+        self.train(
+            dataset=dataset,
+            **kwargs,
+        )
+        block_size = self.memory_budget.block_rows(
+            bytes_per_row=24 * len(self.item_ids),
+            default=kwargs.get("block_size", 1024),
+        )
+
+        user_ids = np.sort(dataset.train.user_id.unique())
+        user_movie_matrix = rating_matrix(dataset.train, user_ids, self.item_ids)
+        mask, excluded = self.candidate_filters(dataset, user_ids, self.item_ids, user_movie_matrix, **kwargs)
+
+        store = load_or_build_store(
+            dataset.train,
+            capacity=num_recent,
+            path=kwargs.get("recent_store_path", None),
+        )
+        self.logger.info(f"recent interactions of {store.num_users} users")
+
+        # a small popularity prior breaks ties and covers users without high ratings
+        popularity = user_movie_matrix.getnnz(axis=0).astype(np.float32)
+        self.prior = 1e-3 * popularity / max(popularity.max(), 1)
+
+        def compute_top_k(compute_user_ids: np.ndarray) -> Dict[int, List[int]]:
+            rows = np.searchsorted(user_ids, compute_user_ids)
+            user2items: Dict[int, List[int]] = {}
+            for start in range(0, len(rows), block_size):
+                block = rows[start : start + block_size]
+                scores = self.score_recent(store.recent_matrix(user_ids[block], self.item_ids))
+                indexes, top_scores = select_top_k(
+                    scores,
+                    k=top_k,
+                    exclude=excluded[block],
+                    mask=mask,
+                )
+                user2items.update(to_user2items(user_ids[block], self.item_ids, indexes, top_scores))
+            return user2items
+
+        pred_user2items = self.cached_top_k(user_ids, top_k, compute_top_k, filters=self.cache_filters(**kwargs))
+
+        dataset.test["rating_pred"] = self.predict_rating(
+            user_movie_matrix=user_movie_matrix,
+            user_ids=user_ids,
+            test_user_ids=dataset.test.user_id.values,
+            test_movie_ids=dataset.test.movie_id.values,
+            average_score=dataset.train.rating.mean(),
+        )
+
+        recommendation = RecommendResult(
+            rating=dataset.test.rating_pred,
+            user2items=pred_user2items,
+        )
+        self.logger.info("done recommendation")
+        return recommendation
+
+    def score_recent(
+        self,
+        user_recent_matrix: sparse.csr_matrix,
+    ) -> np.ndarray:
+        """similarity of every movie to the recent movies of each row, plus the popularity prior."""
+        return np.asarray((user_recent_matrix @ self.neighbors).toarray() + self.prior)
+
+    def recommend_recent(
+        self,
+        store: RecentInteractionStore,
+        user_id: int,
+        evaluated_movie_ids: np.ndarray,
+        top_k: int = 10,
+    ) -> List[int]:
+        """top_k movies for one user from the current content of store; usable per request."""
+        scores = self.score_recent(store.recent_matrix(np.array([user_id]), self.item_ids))
+        evaluated = np.isin(self.item_ids, evaluated_movie_ids)[np.newaxis, :]
+        indexes, top_scores = select_top_k(
+            scores,
+            k=top_k,
+            exclude=sparse.csr_matrix(evaluated),
+        )
+        return to_user2items(np.array([user_id]), self.item_ids, indexes, top_scores).get(user_id, [])
+
+    def _fold_in(
+        self,
+        ratings: pd.DataFrame,
+        top_k: int,
+        dataset: Optional[Dataset],
+        **kwargs,
+    ) -> Dict[int, List[int]]:
+        """score the new users' recent high-rated movies through the frozen content neighbors and prior."""
+        user_ids = np.sort(ratings.user_id.unique())
+        recent = recent_items(ratings, num_recent=kwargs.get("num_recent", 5))
+        recent = recent[recent.movie_id.isin(self.item_ids)]
+        user_movie_matrix = rating_matrix(ratings[ratings.movie_id.isin(self.item_ids)], user_ids, self.item_ids)
+        mask, excluded = self.candidate_filters(dataset, user_ids, self.item_ids, user_movie_matrix, **kwargs)
+        indexes, top_scores = select_top_k(
+            self.score_recent(rating_matrix(recent, user_ids, self.item_ids, values=np.ones(len(recent)))),
+            k=top_k,
+            exclude=excluded,
+            mask=mask,
+        )
+        return to_user2items(user_ids, self.item_ids, indexes, top_scores)
+
+    def predict_rating(
+        self,
+        user_movie_matrix: sparse.csr_matrix,
+        user_ids: np.ndarray,
+        test_user_ids: np.ndarray,
+        test_movie_ids: np.ndarray,
+        average_score: float,
+    ) -> np.ndarray:
+        """similarity weighted average of the user's ratings on the neighbors of each test movie."""
+        pred_results = np.full(len(test_user_ids), average_score, dtype=np.float32)
+        user_indexes = np.searchsorted(user_ids, test_user_ids)
+        known = (user_indexes < len(user_ids)) & (
+            user_ids[np.minimum(user_indexes, len(user_ids) - 1)] == test_user_ids
+        )
+        if not known.any():
+            return pred_results
+
+        user_ratings = user_movie_matrix[user_indexes[known]]
+        similarities = self.neighbors[np.searchsorted(self.item_ids, test_movie_ids[known])]
+        numerator = np.asarray(user_ratings.multiply(similarities).sum(axis=1)).ravel()
+        denominator = np.asarray((user_ratings > 0).multiply(similarities).sum(axis=1)).ravel()
+
+        user_means = np.asarray(user_ratings.sum(axis=1)).ravel() / np.maximum(user_ratings.getnnz(axis=1), 1)
+        pred_results[known] = np.where(
+            denominator > 0,
+            numerator / np.maximum(denominator, 1e-12),
+            user_means,
+        )
+        return pred_results
@@ -0,0 +1,189 @@
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from src.algorithms.base_recommender import BaseRecommender
+from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import rating_matrix, ratings_fingerprint
+from src.models.neighbors import load_neighbors, save_neighbors, top_n_cosine_neighbors
+from src.models.topk import select_top_k, to_user2items
+
+
+def center_by_user(user_movie_matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    user_means = np.asarray(user_movie_matrix.sum(axis=1)).ravel() / np.maximum(user_movie_matrix.getnnz(axis=1), 1)
+    centered = user_movie_matrix.copy()
+    centered.data -= np.repeat(user_means, np.diff(centered.indptr)).astype(np.float32)
+    return centered
+
+
+class IMCFRecommender(BaseRecommender):
+    supports_fold_in = True
+
+    def __init__(
+        self,
+        num_users: int = 1000,
+        num_test_items: int = 5,
+        data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
+    ):
+        super().__init__(
+            num_users=num_users,
+            num_test_items=num_test_items,
+            data_path=data_path,
+            memory_budget=memory_budget,
+        )
+        self.item_ids: np.ndarray = np.empty(0, dtype=np.int32)
+        self.neighbors: sparse.csr_matrix = None
+        np.random.seed(0)
+        self.logger.info("initialized imcf recommender")
+
+    def train(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ):
+        self.update_model_version(dataset, **kwargs)
+        num_neighbors = kwargs.get("num_neighbors", 30)
+        num_threads = kwargs.get("num_threads", None)
+        neighbor_path = kwargs.get("neighbor_path", None)
+
+        # neighbors saved from other ratings or another num_neighbors are rebuilt and overwritten
+        key = ratings_fingerprint(dataset.train, num_neighbors) if neighbor_path is not None else ""
+        if neighbor_path is not None and os.path.exists(neighbor_path):
+            loaded = load_neighbors(neighbor_path, key)
+            if loaded is not None:
+                self.logger.info(f"load item neighbors: {neighbor_path}")
+                self.neighbors, self.item_ids = loaded
+                return
+            self.logger.info(f"item neighbors at {neighbor_path} were built from other ratings or parameters, rebuild")
+
+        user_ids = np.sort(dataset.train.user_id.unique())
+        self.item_ids = np.sort(dataset.train.movie_id.unique())
+        user_movie_matrix = rating_matrix(dataset.train, user_ids, self.item_ids)
+        block_size = self.memory_budget.block_rows(
+            bytes_per_row=16 * len(self.item_ids),
+            default=kwargs.get("block_size", 1024),
+        )
+
+        # adjusted cosine: item vectors over users with each user's mean removed
+        self.neighbors = top_n_cosine_neighbors(
+            features=center_by_user(user_movie_matrix).T.tocsr(),
+            num_neighbors=num_neighbors,
+            block_size=block_size,
+            num_threads=num_threads,
+        )
+        self.logger.info(f"item neighbors: {self.neighbors.shape} with {self.neighbors.nnz} similarities")
+
+        if neighbor_path is not None:
+            save_neighbors(neighbor_path, self.neighbors, self.item_ids, key)
+            self.logger.info(f"saved item neighbors: {neighbor_path}")
+
+    def recommend(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ) -> RecommendResult:
+        self.logger.info("start recommendation")
+
+        top_k = kwargs.get("top_k", 10)
+
+        self.train(
+            dataset=dataset,
+            **kwargs,
+        )
+        block_size = self.memory_budget.block_rows(
+            bytes_per_row=24 * len(self.item_ids),
+            default=kwargs.get("block_size", 1024),
+        )
+
+        train = dataset.train[dataset.train.movie_id.isin(self.item_ids)]
+        user_ids = np.sort(train.user_id.unique())
+        user_movie_matrix = rating_matrix(train, user_ids, self.item_ids)
+        centered = center_by_user(user_movie_matrix)
+        mask, excluded = self.candidate_filters(dataset, user_ids, self.item_ids, user_movie_matrix, **kwargs)
+
+        def compute_top_k(compute_user_ids: np.ndarray) -> Dict[int, List[int]]:
+            rows = np.searchsorted(user_ids, compute_user_ids)
+            user2items: Dict[int, List[int]] = {}
+            for start in range(0, len(rows), block_size):
+                block = rows[start : start + block_size]
+                scores = (centered[block] @ self.neighbors).toarray()
+                indexes, top_scores = select_top_k(
+                    scores,
+                    k=top_k,
+                    exclude=excluded[block],
+                    mask=mask,
+                )
+                user2items.update(to_user2items(user_ids[block], self.item_ids, indexes, top_scores))
+            return user2items
+
+        pred_user2items = self.cached_top_k(user_ids, top_k, compute_top_k, filters=self.cache_filters(**kwargs))
+
+        dataset.test["rating_pred"] = self.predict_rating(
+            user_movie_matrix=user_movie_matrix,
+            user_ids=user_ids,
+            test_user_ids=dataset.test.user_id.values,
+            test_movie_ids=dataset.test.movie_id.values,
+            average_score=dataset.train.rating.mean(),
+        )
+
+        recommendation = RecommendResult(
+            rating=dataset.test.rating_pred,
+            user2items=pred_user2items,
+        )
+        self.logger.info("done recommendation")
+        return recommendation
+
+    def _fold_in(
+        self,
+        ratings: pd.DataFrame,
+        top_k: int,
+        dataset: Optional[Dataset],
+        **kwargs,
+    ) -> Dict[int, List[int]]:
+        """score the new users' mean-centred ratings through the frozen item neighbors, as recommend does."""
+        user_ids = np.sort(ratings.user_id.unique())
+        user_movie_matrix = rating_matrix(ratings[ratings.movie_id.isin(self.item_ids)], user_ids, self.item_ids)
+        mask, excluded = self.candidate_filters(dataset, user_ids, self.item_ids, user_movie_matrix, **kwargs)
+        indexes, top_scores = select_top_k(
+            (center_by_user(user_movie_matrix) @ self.neighbors).toarray(),
+            k=top_k,
+            exclude=excluded,
+            mask=mask,
+        )
+        return to_user2items(user_ids, self.item_ids, indexes, top_scores)
+
+    def predict_rating(
+        self,
+        user_movie_matrix: sparse.csr_matrix,
+        user_ids: np.ndarray,
+        test_user_ids: np.ndarray,
+        test_movie_ids: np.ndarray,
+        average_score: float,
+    ) -> np.ndarray:
+        """user mean plus the similarity weighted mean deviation on the neighbors of each test movie."""
+        pred_results = np.full(len(test_user_ids), average_score, dtype=np.float32)
+        user_indexes = np.minimum(np.searchsorted(user_ids, test_user_ids), len(user_ids) - 1)
+        item_indexes = np.minimum(np.searchsorted(self.item_ids, test_movie_ids), len(self.item_ids) - 1)
+        known_user = user_ids[user_indexes] == test_user_ids
+        known_item = self.item_ids[item_indexes] == test_movie_ids
+
+        user_ratings = user_movie_matrix[user_indexes[known_user]]
+        user_means = np.asarray(user_ratings.sum(axis=1)).ravel() / np.maximum(user_ratings.getnnz(axis=1), 1)
+        pred_results[known_user] = user_means
+
+        known = known_user & known_item
+        user_ratings = user_movie_matrix[user_indexes[known]]
+        user_means = user_means[known[known_user]]
+        deviations = center_by_user(user_ratings)
+        similarities = self.neighbors[item_indexes[known]]
+        numerator = np.asarray(deviations.multiply(similarities).sum(axis=1)).ravel()
+        denominator = np.asarray((user_ratings > 0).multiply(similarities).sum(axis=1)).ravel()
+        pred_results[known] = user_means + np.where(
+            denominator > 0,
+            numerator / np.maximum(denominator, 1e-12),
+            0,
+        )
+        return np.clip(pred_results, 0.5, 5)
@@ -0,0 +1,257 @@
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from gensim.models import Word2Vec
+from scipy import sparse
+from src.algorithms.base_recommender import BaseRecommender
+from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import rating_matrix, recent_items
+from src.models.quantized_factors import QuantizationBenchmark, QuantizedFactors, benchmark_quantized, quantized_top_k
+from src.models.topk import select_top_k, to_user2items
+
+
+class UserSequences(object):
+    """
+    Restartable stream of each user's high rated movie ids in timestamp order.
+    Only the sorted id array is held; every pass yields one sentence at a time.
+    """
+
+    def __init__(
+        self,
+        ratings: pd.DataFrame,
+        min_rating: float = 4,
+    ):
+        high_rating = ratings[ratings.rating >= min_rating].sort_values(["user_id", "timestamp"], kind="stable")
+        self.movie_ids = high_rating.movie_id.values
+        user_ids = high_rating.user_id.values
+        self.boundaries = np.flatnonzero(np.diff(user_ids)) + 1
+
+    def __iter__(self) -> Iterator[List[int]]:
+        start = 0
+        for stop in [*self.boundaries, len(self.movie_ids)]:
+            yield self.movie_ids[start:stop].tolist()
+            start = stop
+
+
+class Item2VecRecommender(BaseRecommender):
+    supports_fold_in = True
+
+    def __init__(
+        self,
+        num_users: int = 1000,
+        num_test_items: int = 5,
+        data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
+    ):
+        super().__init__(
+            num_users=num_users,
+            num_test_items=num_test_items,
+            data_path=data_path,
+            memory_budget=memory_budget,
+        )
+        self.model: Word2Vec = None
+        self.item_ids: np.ndarray = np.empty(0, dtype=np.int32)
+        self.item_vectors: np.ndarray = np.empty((0, 0), dtype=np.float32)
+        self.quantized_vectors: Optional[QuantizedFactors] = None
+        self.prior: np.ndarray = np.empty(0, dtype=np.float32)
+        np.random.seed(0)
+        self.logger.info("initialized item2vec recommender")
+
+    def train(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ):
+        self.update_model_version(dataset, **kwargs)
+        vector_size = kwargs.get("vector_size", 64)
+        window = kwargs.get("window", 10)
+        epochs = kwargs.get("epochs", 10)
+        min_count = kwargs.get("min_count", 5)
+        num_threads = kwargs.get("num_threads", 4)
+
+        self.model = Word2Vec(
+            sentences=UserSequences(dataset.train),
+            vector_size=vector_size,
+            window=window,
+            min_count=min_count,
+            sg=1,
+            epochs=epochs,
+            workers=num_threads,
+            seed=0,
+        )
+
+        self.item_ids = np.sort(np.array(self.model.wv.index_to_key, dtype=np.int32))
+        item_vectors = self.model.wv[self.item_ids.tolist()]
+        self.item_vectors = item_vectors / np.maximum(np.linalg.norm(item_vectors, axis=1, keepdims=True), 1e-12)
+        self.logger.info(f"item vectors: {self.item_vectors.shape}")
+        # recommend replaces this with the popularity prior of the users it scores
+        self.prior = np.zeros(len(self.item_ids), dtype=np.float32)
+
+        self.quantized_vectors = None
+        if kwargs.get("quantize", False):
+            # only the int8 codes stay resident; the float32 vectors always move to a memory-mapped temp file,
+            # read back for shortlisted items only. The model holds another float32 copy, so it is released.
+            self.quantized_vectors = QuantizedFactors.quantize(self.item_vectors)
+            exact_vectors = self.memory_budget.spill(self.item_vectors.shape, np.float32)
+            exact_vectors[:] = self.item_vectors
+            exact_vectors.flush()
+            self.item_vectors = exact_vectors
+            self.model = None
+            self.logger.info(
+                f"quantized item vectors: {self.quantized_vectors.nbytes / 1024 ** 2:.2f} MiB "
+                f"(float32 {self.item_vectors.nbytes / 1024 ** 2:.2f} MiB)"
+            )
+
+    def user_vectors(self, user_recent_matrix: sparse.csr_matrix) -> np.ndarray:
+        """unit-length sum of the vectors of each user's recent movies; users without any stay zero."""
+        user_vectors = np.asarray(user_recent_matrix @ self.item_vectors, dtype=np.float32)
+        user_vectors /= np.maximum(np.linalg.norm(user_vectors, axis=1, keepdims=True), 1e-12)
+        return user_vectors
+
+    def user_inputs(
+        self,
+        dataset: Dataset,
+        num_recent: int,
+    ) -> Tuple[np.ndarray, sparse.csr_matrix, sparse.csr_matrix, np.ndarray]:
+        """sorted user ids, their rating and recent-movie matrices over self.item_ids and the popularity prior."""
+        user_ids = np.sort(dataset.train.user_id.unique())
+        train = dataset.train[dataset.train.movie_id.isin(self.item_ids)]
+        user_movie_matrix = rating_matrix(train, user_ids, self.item_ids)
+
+        recent = recent_items(train, num_recent=num_recent)
+        user_recent_matrix = rating_matrix(
+            recent,
+            user_ids,
+            self.item_ids,
+            values=np.ones(len(recent)),
+        )
+
+        # a small popularity prior breaks ties and covers users without high ratings
+        popularity = user_movie_matrix.getnnz(axis=0).astype(np.float32)
+        prior = 1e-3 * popularity / max(popularity.max(), 1)
+        return user_ids, user_movie_matrix, user_recent_matrix, prior
+
+    def score_top_k(
+        self,
+        user_vectors: np.ndarray,
+        k: int,
+        exclude: sparse.csr_matrix,
+        mask: Optional[np.ndarray] = None,
+        shortlist_size: int = 20,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """top k item indexes and scores of user_vectors against the item vectors plus the prior."""
+        if self.quantized_vectors is None:
+            return select_top_k(
+                user_vectors @ self.item_vectors.T + self.prior,
+                k=k,
+                exclude=exclude,
+                mask=mask,
+            )
+        return quantized_top_k(
+            user_vectors,
+            self.quantized_vectors,
+            self.item_vectors,
+            k=k,
+            shortlist_size=shortlist_size,
+            exclude=exclude,
+            mask=mask,
+            bias=self.prior,
+        )
+
+    def recommend(
+        self,
+        dataset: Dataset,
+        **kwargs,
+    ) -> RecommendResult:
+        self.logger.info("start recommendation")
+
+        top_k = kwargs.get("top_k", 10)
+        num_recent = kwargs.get("num_recent", 5)
+        shortlist_size = kwargs.get("shortlist_size", 20)
+
+        self.train(
+            dataset=dataset,
+            **kwargs,
+        )
+        block_size = self.memory_budget.block_rows(
+            bytes_per_row=24 * len(self.item_ids),
+            default=kwargs.get("block_size", 1024),
+        )
+
+        user_ids, user_movie_matrix, user_recent_matrix, self.prior = self.user_inputs(dataset, num_recent)
+        mask, excluded = self.candidate_filters(dataset, user_ids, self.item_ids, user_movie_matrix, **kwargs)
+
+        def compute_top_k(compute_user_ids: np.ndarray) -> Dict[int, List[int]]:
+            rows = np.searchsorted(user_ids, compute_user_ids)
+            user2items: Dict[int, List[int]] = {}
+            for start in range(0, len(rows), block_size):
+                block = rows[start : start + block_size]
+                indexes, top_scores = self.score_top_k(
+                    self.user_vectors(user_recent_matrix[block]),
+                    k=top_k,
+                    exclude=excluded[block],
+                    mask=mask,
+                    shortlist_size=shortlist_size,
+                )
+                user2items.update(to_user2items(user_ids[block], self.item_ids, indexes, top_scores))
+            return user2items
+
+        pred_user2items = self.cached_top_k(user_ids, top_k, compute_top_k, filters=self.cache_filters(**kwargs))
+
+        # embeddings carry no rating scale; fall back to each user's mean rating
+        dataset.test["rating_pred"] = (
+            dataset.test.user_id.map(dataset.user_stats["mean"]).fillna(dataset.train.rating.mean()).values
+        )
+
+        recommendation = RecommendResult(
+            rating=dataset.test.rating_pred,
+            user2items=pred_user2items,
+        )
+        self.logger.info("done recommendation")
+        return recommendation
+
+    def _fold_in(
+        self,
+        ratings: pd.DataFrame,
+        top_k: int,
+        dataset: Optional[Dataset],
+        **kwargs,
+    ) -> Dict[int, List[int]]:
+        """embed the new users from the frozen vectors of their recent high-rated movies, as recommend does."""
+        user_ids = np.sort(ratings.user_id.unique())
+        ratings = ratings[ratings.movie_id.isin(self.item_ids)]
+        recent = recent_items(ratings, num_recent=kwargs.get("num_recent", 5))
+        user_recent_matrix = rating_matrix(recent, user_ids, self.item_ids, values=np.ones(len(recent)))
+        mask, excluded = self.candidate_filters(
+            dataset, user_ids, self.item_ids, rating_matrix(ratings, user_ids, self.item_ids), **kwargs
+        )
+        indexes, top_scores = self.score_top_k(
+            self.user_vectors(user_recent_matrix),
+            k=top_k,
+            exclude=excluded,
+            mask=mask,
+            shortlist_size=kwargs.get("shortlist_size", 20),
+        )
+        return to_user2items(user_ids, self.item_ids, indexes, top_scores)
+
+    def benchmark_quantization(
+        self,
+        dataset: Dataset,
+        k: int = 10,
+        shortlist_sizes: Sequence[int] = (10, 20, 50, 100, 200),
+        **kwargs,
+    ) -> List[QuantizationBenchmark]:
+        """train on dataset and compare int8 retrieval + exact re-ranking with exact float32 scoring of every user."""
+        self.train(
+            dataset=dataset,
+            **{**kwargs, "quantize": False},
+        )
+        _, _, user_recent_matrix, prior = self.user_inputs(dataset, kwargs.get("num_recent", 5))
+        return benchmark_quantized(
+            self.user_vectors(user_recent_matrix),
+            self.item_vectors,
+            k=k,
+            shortlist_sizes=shortlist_sizes,
+            bias=prior,
+        )
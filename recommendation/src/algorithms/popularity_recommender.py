@@ -1,8 +1,10 @@
 from collections import defaultdict
+from typing import Optional
 
 import numpy as np
 from src.algorithms.base_recommender import BaseRecommender
 from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import rating_matrix
 
 
 class PopularityRecommender(BaseRecommender):
@@ -11,11 +13,13 @@ class PopularityRecommender(BaseRecommender):
         num_users: int = 1000,
         num_test_items: int = 5,
         data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
     ):
         super().__init__(
             num_users=num_users,
             num_test_items=num_test_items,
             data_path=data_path,
+            memory_budget=memory_budget,
         )
         np.random.seed(0)
         self.logger.info("initialized popularity recommender")
@@ -27,12 +31,12 @@ class PopularityRecommender(BaseRecommender):
     ):
         minimum_num_rating = kwargs.get("minimum_num_rating", 200)
 
-        movie_stats = dataset.train.groupby("movie_id").agg({"rating": [np.size, np.mean]})
-        atleast_flg = movie_stats["rating"]["size"] >= minimum_num_rating
+        movie_stats = dataset.movie_stats
+        atleast_flg = movie_stats["count"] >= minimum_num_rating
         self.movies_sorted_by_rating = (
             movie_stats[atleast_flg]
             .sort_values(
-                by=("rating", "mean"),
+                by="mean",
                 ascending=False,
             )
             .index.tolist()
@@ -49,17 +53,27 @@ class PopularityRecommender(BaseRecommender):
             **kwargs,
         )
 
-        user_watched_movies = dataset.train.groupby("user_id").agg({"movie_id": list})["movie_id"].to_dict()
+        top_k = kwargs.get("top_k", 10)
+        user_ids = np.sort(dataset.train.user_id.unique())
+        movie_ids = np.sort(dataset.train.movie_id.unique())
+        mask, excluded = self.candidate_filters(
+            dataset, user_ids, movie_ids, rating_matrix(dataset.train, user_ids, movie_ids), **kwargs
+        )
+        # positions of the ranked movies that pass the item filter
+        ranked = np.searchsorted(movie_ids, self.movies_sorted_by_rating).astype(np.int64)
+        if mask is not None:
+            ranked = ranked[mask[ranked]]
 
         pred_user2items = defaultdict(list)
-        for user_id in dataset.train.user_id.unique():
-            for movie_id in self.movies_sorted_by_rating:
-                if movie_id not in user_watched_movies[user_id]:
-                    pred_user2items[user_id].append(movie_id)
-                if len(pred_user2items[user_id]) == 10:
+        for i, user_id in enumerate(user_ids.tolist()):
+            watched = set(excluded.indices[excluded.indptr[i] : excluded.indptr[i + 1]].tolist())
+            for j in ranked.tolist():
+                if j not in watched:
+                    pred_user2items[user_id].append(int(movie_ids[j]))
+                if len(pred_user2items[user_id]) == top_k:
                     break
 
-        movie_rating_average = dataset.train.groupby("movie_id").agg({"rating": np.mean})
+        movie_rating_average = dataset.movie_stats[["mean"]].rename(columns={"mean": "rating"})
         movie_rating_predict = dataset.test.merge(
             movie_rating_average,
             on="movie_id",
@@ -1,9 +1,22 @@
-from collections import defaultdict
-from typing import List
+from typing import Dict, List, Optional, Union
 
 import numpy as np
 from src.algorithms.base_recommender import BaseRecommender
 from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import rating_matrix
+from src.utils.hashing import keyed_sample, keyed_uniform
+
+# keeps the candidate stream of keyed_sample independent of the rating scores
+_SAMPLE_STREAM = 0x5A3C1E5EED
+
+
+def random_rating(
+    seed: int,
+    user_ids: Union[int, np.ndarray],
+    movie_ids: np.ndarray,
+) -> np.ndarray:
+    """uniform rating in [0.5, 5.0) keyed by (seed, user, movie)."""
+    return 0.5 + 4.5 * keyed_uniform(seed, user_ids, movie_ids)
 
 
 class RandomRecommender(BaseRecommender):
@@ -12,13 +25,14 @@ class RandomRecommender(BaseRecommender):
         num_users: int = 1000,
         num_test_items: int = 5,
         data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
     ):
         super().__init__(
             num_users=num_users,
             num_test_items=num_test_items,
             data_path=data_path,
+            memory_budget=memory_budget,
         )
-        np.random.seed(0)
         self.logger.info("initialized random recommender")
 
     def train(
@@ -26,7 +40,8 @@ class RandomRecommender(BaseRecommender):
         dataset: Dataset,
         **kwargs,
     ):
-        pass
+        # nothing to fit; the seed and the training ratings still version the cached lists
+        self.update_model_version(dataset, **kwargs)
 
     def recommend(
         self,
@@ -34,46 +49,41 @@ class RandomRecommender(BaseRecommender):
         **kwargs,
     ) -> RecommendResult:
         self.logger.info("start recommendation")
-        unique_user_ids = sorted(dataset.train.user_id.unique())
-        unique_movie_ids = sorted(dataset.train.movie_id.unique())
-        user_id2index = dict(zip(unique_user_ids, range(len(unique_user_ids))))
-        movie_id2index = dict(zip(unique_movie_ids, range(len(unique_movie_ids))))
-
-        pred_matrix = np.random.uniform(
-            0.5,
-            5.0,
-            (len(unique_user_ids), len(unique_movie_ids)),
+        top_k = kwargs.get("top_k", 10)
+        seed = kwargs.get("seed", 0)
+        self.train(
+            dataset=dataset,
+            **kwargs,
         )
-        pred_results: List[float] = []
-        for i, row in dataset.test.iterrows():
-            if i % 1000 == 0:
-                self.logger.info(f"at {i} row")
-            if row["user_id"] not in user_id2index:
-                pred_results.append(np.random.uniform(0.5, 5.0))
-                continue
-            if row["movie_id"] not in movie_id2index:
-                pred_results.append(np.random.uniform(0.5, 5.0))
-                continue
-            user_index = user_id2index[row["user_id"]]
-            movie_index = movie_id2index[row["movie_id"]]
-            pred_score: float = float(pred_matrix[user_index, movie_index])
-            pred_results.append(pred_score)
-        dataset.test["rating_pred"] = pred_results
+        unique_user_ids = np.sort(dataset.train.user_id.unique())
+        unique_movie_ids = np.sort(dataset.train.movie_id.unique())
+        user_movie_matrix = rating_matrix(dataset.train, unique_user_ids, unique_movie_ids)
+        mask, excluded = self.candidate_filters(dataset, unique_user_ids, unique_movie_ids, user_movie_matrix, **kwargs)
+        # movies are drawn from the positions of the candidates that pass the item filter
+        candidates = np.arange(len(unique_movie_ids)) if mask is None else np.flatnonzero(mask)
+
+        # a score is a pure function of (seed, user, movie), so any sharding of users gives the same result
+        dataset.test["rating_pred"] = random_rating(seed, dataset.test.user_id.values, dataset.test.movie_id.values)
 
-        pred_user2items = defaultdict(list)
+        def compute_top_k(compute_user_ids: np.ndarray) -> Dict[int, List[int]]:
+            user2items: Dict[int, List[int]] = {}
+            for user_id, i in zip(compute_user_ids, np.searchsorted(unique_user_ids, compute_user_ids)):
+                rated = excluded.indices[excluded.indptr[i] : excluded.indptr[i + 1]]
+                rated = np.searchsorted(candidates, rated[np.isin(rated, candidates)])
+                # k unrated movies drawn without replacement; equivalent in distribution to the top k of iid scores
+                sampled = keyed_sample(
+                    seed ^ _SAMPLE_STREAM,
+                    int(user_id),
+                    population=len(candidates),
+                    k=top_k,
+                    exclude=rated,
+                )
+                movie_ids = unique_movie_ids[candidates[sampled]]
+                order = np.argsort(-random_rating(seed, user_id, movie_ids), kind="stable")
+                user2items[int(user_id)] = movie_ids[order].tolist()
+            return user2items
 
-        user_evaluated_movies = dataset.train.groupby("user_id").agg({"movie_id": list})["movie_id"].to_dict()
-        for i, user_id in enumerate(unique_user_ids):
-            if i % 200 == 0:
-                self.logger.info(f"at {i} user")
-            user_index = user_id2index[user_id]
-            movie_indexes = np.argsort(-pred_matrix[user_index, :])
-            for j, movie_index in enumerate(movie_indexes):
-                movie_id = unique_movie_ids[movie_index]
-                if movie_id not in user_evaluated_movies[user_id]:
-                    pred_user2items[user_id].append(movie_id)
-                if len(pred_user2items[user_id]) == 10:
-                    break
+        pred_user2items = self.cached_top_k(unique_user_ids, top_k, compute_top_k, filters=self.cache_filters(**kwargs))
 
         recommendation = RecommendResult(
             rating=dataset.test.rating_pred,
@@ -0,0 +1,155 @@
+import importlib
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple, Type
+
+if TYPE_CHECKING:
+    from src.algorithms.base_recommender import BaseRecommender
+
+
+@dataclass(frozen=True)
+class Param:
+    """
+    A recommend() keyword argument of an algorithm; also becomes the `--name` option of its subcommand,
+    a `--name` flag when its type is bool.
+    """
+
+    name: str
+    type: type
+    default: Any = None
+    help: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class AlgorithmSpec:
+    """
+    An algorithm known by name. The class is given as "module.Class" and imported only by load(),
+    so listing algorithms or building their CLI options never imports sklearn, surprise, gensim and the like.
+    """
+
+    name: str
+    target: str
+    params: Tuple[Param, ...] = ()
+
+    @property
+    def command_name(self) -> str:
+        return f"{self.name.replace('_', '-')}-recommend"
+
+    def load(self) -> Type["BaseRecommender"]:
+        module_name, class_name = self.target.rsplit(".", 1)
+        recommender_class: Type["BaseRecommender"] = getattr(importlib.import_module(module_name), class_name)
+        return recommender_class
+
+    def defaults(self) -> Dict[str, Any]:
+        return {param.name: param.default for param in self.params}
+
+
+ALGORITHMS: Dict[str, AlgorithmSpec] = {}
+
+
+def register(spec: AlgorithmSpec) -> AlgorithmSpec:
+    if spec.name in ALGORITHMS:
+        raise ValueError(f"algorithm {spec.name} is already registered")
+    ALGORITHMS[spec.name] = spec
+    return spec
+
+
+def get_algorithm(name: str) -> AlgorithmSpec:
+    if name not in ALGORITHMS:
+        raise KeyError(f"unknown algorithm {name}; choose from {sorted(ALGORITHMS)}")
+    return ALGORITHMS[name]
+
+
+register(
+    AlgorithmSpec(
+        name="random",
+        target="src.algorithms.random_recommender.RandomRecommender",
+        params=(Param("seed", int, 0),),
+    )
+)
+register(
+    AlgorithmSpec(
+        name="popularity",
+        target="src.algorithms.popularity_recommender.PopularityRecommender",
+        params=(Param("minimum_num_rating", int, 200),),
+    )
+)
+register(
+    AlgorithmSpec(
+        name="association",
+        target="src.algorithms.association_recommender.AssociationRecommender",
+        params=(
+            Param("min_support", float, 0.1),
+            Param("min_threshold", float, 1.0),
+            Param("num_recent", int, 5),
+            Param("recent_store_path", str, None),
+        ),
+    )
+)
+register(
+    AlgorithmSpec(
+        name="umcf",
+        target="src.algorithms.umcf_recommender.UMCFRecommender",
+        params=(Param("num_neighbors", int, 30),),
+    )
+)
+register(
+    AlgorithmSpec(
+        name="regression",
+        target="src.algorithms.regression_recommendation.RegressionRecommendation",
+        params=(
+            Param("n_estimators", int, 100),
+            Param("max_depth", int, None),
+            Param("min_samples_leaf", int, 1),
+            Param("onnx_path", str, None),
+            Param("onnx_threads", int, 1),
+        ),
+    )
+)
+register(
+    AlgorithmSpec(
+        name="content_based",
+        target="src.algorithms.content_based_recommender.ContentBasedRecommender",
+        params=(
+            Param("num_neighbors", int, 100),
+            Param("num_recent", int, 5),
+            Param("recent_store_path", str, None),
+        ),
+    )
+)
+register(
+    AlgorithmSpec(
+        name="imcf",
+        target="src.algorithms.imcf_recommender.IMCFRecommender",
+        params=(
+            Param("num_neighbors", int, 30),
+            Param("num_threads", int, None),
+            Param("neighbor_path", str, None),
+        ),
+    )
+)
+register(
+    AlgorithmSpec(
+        name="item2vec",
+        target="src.algorithms.item2vec_recommender.Item2VecRecommender",
+        params=(
+            Param("vector_size", int, 64),
+            Param("window", int, 10),
+            Param("epochs", int, 10),
+            Param("min_count", int, 5),
+            Param("num_threads", int, 4),
+            Param("num_recent", int, 5),
+            Param(
+                "quantize",
+                bool,
+                False,
+                "retrieve candidates with int8 item vectors, then re-rank them exactly from float32 vectors kept on disk",
+            ),
+            Param(
+                "shortlist_size",
+                int,
+                20,
+                "candidates per user re-ranked exactly when quantized; 20 keeps recall@10 against float32 above 0.99",
+            ),
+        ),
+    )
+)
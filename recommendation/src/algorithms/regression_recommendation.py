@@ -1,10 +1,14 @@
-import itertools
-from collections import Counter, defaultdict
+import time
+from typing import Callable, Dict, List, Optional
 
 import numpy as np
+import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
 from src.algorithms.base_recommender import BaseRecommender
 from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import index_with_default, rating_matrix
+from src.models.onnx_regression import OnnxRegressionEngine, export_regression
+from src.models.topk import select_top_k, to_user2items
 
 
 class RegressionRecommendation(BaseRecommender):
@@ -13,13 +17,18 @@ class RegressionRecommendation(BaseRecommender):
         num_users: int = 1000,
         num_test_items: int = 5,
         data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
     ):
         super().__init__(
             num_users=num_users,
             num_test_items=num_test_items,
             data_path=data_path,
+            memory_budget=memory_budget,
         )
         self.reg: RandomForestRegressor = None
+        self.user_table: pd.DataFrame = None
+        self.movie_table: pd.DataFrame = None
+        self.feature_names: List[str] = []
         np.random.seed(0)
         self.logger.info("initialized regression recommender")
 
@@ -28,15 +37,46 @@ class RegressionRecommendation(BaseRecommender):
         dataset: Dataset,
         **kwargs,
     ):
+        self.update_model_version(dataset, **kwargs)
         self.reg = RandomForestRegressor(
-            n_jobs=-1,
+            n_estimators=kwargs.get("n_estimators", 100),
+            max_depth=kwargs.get("max_depth", None),
+            min_samples_leaf=kwargs.get("min_samples_leaf", 1),
+            n_jobs=kwargs.get("n_jobs", -1),
             random_state=0,
         )
         self.reg.fit(
-            self.train_x.values,
+            self.train_x,
             self.train_y,
         )
 
+    def build_features(
+        self,
+        user_ids: np.ndarray,
+        movie_ids: np.ndarray,
+    ) -> np.ndarray:
+        """feature rows of (user, movie) pairs; users and movies unseen in training get the average rating."""
+        user_indexes = index_with_default(user_ids, self.user_table.index.values)
+        movie_indexes = index_with_default(movie_ids, self.movie_table.index.values)
+        features = self.memory_budget.allocate((len(user_indexes), len(self.feature_names)), np.float32)
+        for j, name in enumerate(self.feature_names):
+            if name in self.user_table.columns:
+                column = self.user_table[name].values
+                indexes = user_indexes
+            else:
+                column = self.movie_table[name].values
+                indexes = movie_indexes
+            default = 0 if name.startswith("is_") else self.average_rating
+            features[:, j] = np.append(column, default).astype(np.float32)[indexes]
+        return features
+
+    def predict_with_forest(
+        self,
+        user_ids: np.ndarray,
+        movie_ids: np.ndarray,
+    ) -> np.ndarray:
+        return np.asarray(self.reg.predict(self.build_features(user_ids, movie_ids)), dtype=np.float32)
+
     def recommend(
         self,
         dataset: Dataset,
@@ -44,83 +84,96 @@ class RegressionRecommendation(BaseRecommender):
     ) -> RecommendResult:
         self.logger.info("start recommendation")
 
-        user_movie_matrix = dataset.train.pivot(
-            index="user_id",
-            columns="movie_id",
-            values="rating",
-        )
+        top_k = kwargs.get("top_k", 10)
+        onnx_path = kwargs.get("onnx_path", None)
+        onnx_threads = kwargs.get("onnx_threads", 1)
 
-        self.train_x = dataset.train[["user_id", "movie_id"]]
         self.train_y = dataset.train.rating.values
-
-        test_x = dataset.test[["user_id", "movie_id"]]
-        train_all_x = user_movie_matrix.stack(dropna=False).reset_index()[["user_id", "movie_id"]]
-        train_all_key = train_all_x.copy()
+        self.average_rating = float(self.train_y.mean())
 
         aggregators = ["min", "max", "mean"]
-        user_features = dataset.train.groupby("user_id").rating.agg(aggregators).to_dict()
-        movie_features = dataset.train.groupby("movie_id").rating.agg(aggregators).to_dict()
-        for agg in aggregators:
-            self.train_x[f"u_{agg}"] = self.train_x["user_id"].map(user_features[agg])
-            test_x[f"u_{agg}"] = test_x["user_id"].map(user_features[agg])
-            train_all_x[f"u_{agg}"] = train_all_x["user_id"].map(user_features[agg])
-            self.train_x[f"m_{agg}"] = self.train_x["movie_id"].map(movie_features[agg])
-            test_x[f"m_{agg}"] = test_x["movie_id"].map(movie_features[agg])
-            train_all_x[f"m_{agg}"] = train_all_x["movie_id"].map(movie_features[agg])
-
-        average_rating = self.train_y.mean()
-        test_x.fillna(average_rating, inplace=True)
-
-        movie_genres = dataset.item_content[["movie_id", "genre"]]
-        genres = set(list(itertools.chain(*movie_genres.genre)))
-        for genre in genres:
-            movie_genres[f"is_{genre}"] = movie_genres.genre.apply(lambda x: genre in x)
-        movie_genres.drop("genre", axis=1, inplace=True)
-
-        self.train_x = self.train_x.merge(
-            movie_genres,
-            on="movie_id",
-        ).drop(columns=["user_id", "movie_id"])
-        test_x = test_x.merge(
-            movie_genres,
-            on="movie_id",
-        ).drop(columns=["user_id", "movie_id"])
-        train_all_x = train_all_x.merge(
-            movie_genres,
-            on="movie_id",
-        ).drop(columns=["user_id", "movie_id"])
+        self.user_table = dataset.user_stats[aggregators].add_prefix("u_")
+        movie_genres = pd.DataFrame(
+            (dataset.genre_features.matrix.toarray() > 0).astype(np.float32),
+            index=dataset.item_content.movie_id.values,
+            columns=[f"is_{genre}" for genre in dataset.genre_features.vocabulary],
+        )
+        self.movie_table = movie_genres.join(
+            dataset.movie_stats[aggregators].add_prefix("m_"),
+        ).fillna(self.average_rating)
+        self.feature_names = [f"{prefix}_{agg}" for agg in aggregators for prefix in ["u", "m"]]
+        self.feature_names += movie_genres.columns.tolist()
+
+        self.train_x = self.build_features(dataset.train.user_id.values, dataset.train.movie_id.values)
 
         self.train(
             dataset=dataset,
             **kwargs,
         )
 
-        test_pred = self.reg.predict(test_x.values)
-
-        test_x["rating_pred"] = test_pred
-
-        train_all_pred = self.reg.predict(train_all_x.values)
-
-        train_all_key["rating_pred"] = train_all_pred
-        pred_matrix = train_all_key.pivot(
-            index="user_id",
-            columns="movie_id",
-            values="rating_pred",
+        predict: Callable[[np.ndarray, np.ndarray], np.ndarray]
+        if onnx_path is None:
+            predict = self.predict_with_forest
+        else:
+            export_regression(
+                forest=self.reg,
+                feature_names=self.feature_names,
+                user_table=self.user_table,
+                movie_table=self.movie_table,
+                default_value=self.average_rating,
+                path=onnx_path,
+            )
+            engine = OnnxRegressionEngine(
+                model_path=onnx_path,
+                num_threads=onnx_threads,
+            )
+            predict = engine.predict
+
+        start_time = time.perf_counter()
+        test_pred = predict(dataset.test.user_id.values, dataset.test.movie_id.values)
+
+        user_ids = np.sort(dataset.train.user_id.unique())
+        movie_ids = np.sort(dataset.train.movie_id.unique())
+        user_movie_matrix = rating_matrix(dataset.train, user_ids, movie_ids)
+        mask, excluded = self.candidate_filters(dataset, user_ids, movie_ids, user_movie_matrix, **kwargs)
+
+        # every unrated (user, movie) pair is scored, one block of users at a time
+        block_size = self.memory_budget.block_rows(
+            bytes_per_row=len(movie_ids) * (4 * len(self.feature_names) + 64),
+            default=len(user_ids),
         )
-
-        pred_user2items = defaultdict(list)
-        user_evaluated_movies = dataset.train.groupby("user_id").agg({"movie_id": list})["movie_id"].to_dict()
-        for user_id in dataset.train.user_id.unique():
-            movie_indexes = np.argsort(-pred_matrix.loc[user_id, :]).values  # type: ignore
-            for movie_index in movie_indexes:
-                movie_id = user_movie_matrix.columns[movie_index]
-                if movie_id not in (user_evaluated_movies[user_id]):
-                    pred_user2items[user_id].append(movie_id)
-                if len(pred_user2items[user_id]) == 10:
-                    break
+        num_scored_users = 0
+
+        def compute_top_k(compute_user_ids: np.ndarray) -> Dict[int, List[int]]:
+            nonlocal num_scored_users
+            num_scored_users += len(compute_user_ids)
+            rows = np.searchsorted(user_ids, compute_user_ids)
+            user2items: Dict[int, List[int]] = {}
+            for start in range(0, len(rows), block_size):
+                block = rows[start : start + block_size]
+                pred_matrix = predict(
+                    np.repeat(user_ids[block], len(movie_ids)),
+                    np.tile(movie_ids, len(block)),
+                ).reshape(len(block), len(movie_ids))
+                indexes, scores = select_top_k(
+                    pred_matrix,
+                    k=top_k,
+                    exclude=excluded[block],
+                    mask=mask,
+                )
+                user2items.update(to_user2items(user_ids[block], movie_ids, indexes, scores))
+            return user2items
+
+        pred_user2items = self.cached_top_k(user_ids, top_k, compute_top_k, filters=self.cache_filters(**kwargs))
+
+        elapsed = time.perf_counter() - start_time
+        num_rows = len(test_pred) + num_scored_users * len(movie_ids)
+        self.logger.info(f"scored {num_rows} rows in blocks of {block_size} users: {num_rows / elapsed:.0f} rows/sec")
+
+        dataset.test["rating_pred"] = test_pred
 
         recommendation = RecommendResult(
-            rating=test_x.rating_pred,
+            rating=dataset.test.rating_pred,
             user2items=pred_user2items,
         )
 
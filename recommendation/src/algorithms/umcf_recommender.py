@@ -1,9 +1,10 @@
 from collections import defaultdict
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
 import numpy as np
 from src.algorithms.base_recommender import BaseRecommender
 from src.models.dataset import Dataset, RecommendResult
+from src.models.interactions import rating_matrix
 from surprise import Dataset as SurpriseDataset
 from surprise import KNNWithMeans, Reader
 from surprise.trainset import Trainset
@@ -15,11 +16,13 @@ class UMCFRecommender(BaseRecommender):
         num_users: int = 1000,
         num_test_items: int = 5,
         data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[int] = None,
     ):
         super().__init__(
             num_users=num_users,
             num_test_items=num_test_items,
             data_path=data_path,
+            memory_budget=memory_budget,
         )
         self.knn: KNNWithMeans = None
         self.data_train: Trainset = None
@@ -38,17 +41,49 @@ class UMCFRecommender(BaseRecommender):
             reader,
         ).build_full_trainset()
 
+        # surprise keeps a dense users x users float64 similarity matrix, which no block size can shrink
+        similarity_bytes = 8 * self.data_train.n_users**2
+        if self.memory_budget.limit is not None and similarity_bytes > self.memory_budget.limit:
+            self.logger.warning(
+                f"the {similarity_bytes / 1024 ** 2:.1f} MiB user similarity matrix exceeds the "
+                f"{self.memory_budget.limit / 1024 ** 2:.1f} MiB memory budget; UMCF cannot honour it"
+            )
+
         sim_options = {
             "name": "pearson",
             "user_based": True,
         }
         self.knn = KNNWithMeans(
-            k=30,
+            k=kwargs.get("num_neighbors", 30),
             min_k=1,
             sim_options=sim_options,
         )
         self.knn.fit(self.data_train)
 
+    def build_anti_testset(
+        self,
+        inner_user_ids: List[int],
+        candidate_items: Optional[Set[int]] = None,
+        user_exclusions: Optional[Dict[int, List[int]]] = None,
+    ) -> List[Tuple[int, int, float]]:
+        """
+        Trainset.build_anti_testset restricted to the given inner user ids, to the inner item ids in candidate_items
+        (all when None) and without each user's user_exclusions (raw movie ids by raw user id).
+        """
+        fill = self.data_train.global_mean
+        items = list(self.data_train.all_items()) if candidate_items is None else sorted(candidate_items)
+        anti_testset = []
+        for u in inner_user_ids:
+            raw_user_id = self.data_train.to_raw_uid(u)
+            user_items = {j for (j, _) in self.data_train.ur[u]}
+            excluded = set((user_exclusions or {}).get(raw_user_id, []))
+            anti_testset += [
+                (raw_user_id, self.data_train.to_raw_iid(i), fill)
+                for i in items
+                if i not in user_items and self.data_train.to_raw_iid(i) not in excluded
+            ]
+        return anti_testset
+
     def recommend(
         self,
         dataset: Dataset,
@@ -63,26 +98,8 @@ class UMCFRecommender(BaseRecommender):
             **kwargs,
         )
 
-        user_movie_matrix = dataset.train.pivot(
-            index="user_id",
-            columns="movie_id",
-            values="rating",
-        )
-        user_id2index = dict(
-            zip(
-                user_movie_matrix.index,
-                range(len(user_movie_matrix.index)),
-            )
-        )
-        movie_id2index = dict(
-            zip(
-                user_movie_matrix.columns,
-                range(len(user_movie_matrix.columns)),
-            )
-        )
-
-        data_test = self.data_train.build_anti_testset(None)
-        predictions = self.knn.test(data_test)
+        user_ids = np.sort(dataset.train.user_id.unique())
+        movie_ids = np.sort(dataset.train.movie_id.unique())
 
         def get_top_n(
             preds: List,
@@ -101,22 +118,46 @@ class UMCFRecommender(BaseRecommender):
 
             return top_n
 
-        pred_user2items = get_top_n(
-            preds=predictions,
-            n=top_k,
+        mask, _ = self.candidate_filters(
+            dataset, user_ids, movie_ids, rating_matrix(dataset.train, user_ids, movie_ids), **kwargs
+        )
+        candidate_items = (
+            {self.data_train.to_inner_iid(movie_id) for movie_id in movie_ids[mask].tolist()}
+            if mask is not None
+            else None
+        )
+
+        # the anti testset (every unrated candidate pair) is built and scored one block of users at a time
+        inner_user_ids = list(self.data_train.all_users())
+        block_size = self.memory_budget.block_rows(
+            bytes_per_row=200 * self.data_train.n_items,
+            default=len(inner_user_ids),
         )
+        pred_user2items: Dict[int, List[int]] = {}
+        for start in range(0, len(inner_user_ids), block_size):
+            data_test = self.build_anti_testset(
+                inner_user_ids[start : start + block_size],
+                candidate_items=candidate_items,
+                user_exclusions=kwargs.get("user_exclusions", None),
+            )
+            predictions = self.knn.test(data_test)
+            pred_user2items.update(
+                get_top_n(
+                    preds=predictions,
+                    n=top_k,
+                )
+            )
 
         average_score = dataset.train.rating.mean()
-        pred_results = []
-        for _, row in dataset.test.iterrows():
-            if row["user_id"] not in user_id2index or row["movie_id"] not in movie_id2index:
-                pred_results.append(average_score)
-                continue
-            pred_score = self.knn.predict(
-                uid=row["user_id"],
-                iid=row["movie_id"],
-            ).est
-            pred_results.append(pred_score)
+        test_user_ids = dataset.test.user_id.values
+        test_movie_ids = dataset.test.movie_id.values
+        known = (user_ids[np.minimum(np.searchsorted(user_ids, test_user_ids), len(user_ids) - 1)] == test_user_ids) & (
+            movie_ids[np.minimum(np.searchsorted(movie_ids, test_movie_ids), len(movie_ids) - 1)] == test_movie_ids
+        )
+        pred_results = [
+            self.knn.predict(uid=user_id, iid=movie_id).est if is_known else average_score
+            for user_id, movie_id, is_known in zip(test_user_ids.tolist(), test_movie_ids.tolist(), known.tolist())
+        ]
         dataset.test["rating_pred"] = pred_results
 
         recommendation = RecommendResult(
@@ -1,16 +1,116 @@
-from typing import Any, Dict
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import click
-from src.algorithms.association_recommender import AssociationRecommender
-from src.algorithms.popularity_recommender import PopularityRecommender
-from src.algorithms.random_recommender import RandomRecommender
-from src.algorithms.regression_recommendation import RegressionRecommendation
-from src.algorithms.umcf_recommender import UMCFRecommender
-from src.utils import download, small_ratings
+from src.algorithms.registry import ALGORITHMS, AlgorithmSpec
 from src.utils.logger import configure_logger
 
 logger = configure_logger(__name__)
 
+# heavy libraries (pandas, sklearn, surprise, gensim, ...) are imported inside the commands that use them,
+# so starting a subcommand only costs click and the registry
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", 300))
+
+
+def log_startup(command_name: str):
+    """log the CPU time spent before command_name started, i.e. interpreter start up and imports."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    elapsed_ms = (usage.ru_utime + usage.ru_stime) * 1000
+    if elapsed_ms > STARTUP_BUDGET_MS:
+        logger.warning(f"{command_name} started in {elapsed_ms:.0f} ms, over the {STARTUP_BUDGET_MS:.0f} ms budget")
+    else:
+        logger.info(f"{command_name} started in {elapsed_ms:.0f} ms")
+
+
+def algorithm_command(spec: AlgorithmSpec) -> click.Command:
+    """subcommand of `recommend` with one option per declared param; the algorithm is imported when it runs."""
+
+    @click.pass_obj
+    def run(
+        obj: Dict[str, Any],
+        **params,
+    ):
+        log_startup(spec.command_name)
+        from src.models.item_filters import ItemFilter
+        from src.models.metrics import SampledEvaluation
+        from src.utils.memory import parse_memory_size
+
+        name = spec.name.replace("_", " ")
+        logger.info(f"{name} recommendation")
+        memory_budget = obj.get("memory_budget")
+        recommender = spec.load()(
+            num_users=obj.get("num_users", 1000),
+            num_test_items=obj.get("num_test_items", 5),
+            memory_budget=parse_memory_size(memory_budget) if memory_budget is not None else None,
+        )
+        cache_max_entries = obj.get("cache_max_entries")
+        if cache_max_entries is not None:
+            from src.models.recommendation_cache import RecommendationCache
+
+            recommender.attach_cache(
+                RecommendationCache(
+                    max_entries=cache_max_entries,
+                    ttl_seconds=obj.get("cache_ttl"),
+                )
+            )
+        sampled = obj.get("eval_sample_users") is not None or obj.get("eval_max_ci_width") is not None
+        recommender.run_sample(
+            k=obj.get("top_k", 10),
+            evaluation=SampledEvaluation(
+                sample_size=obj.get("eval_sample_users"),
+                max_ci_width=obj.get("eval_max_ci_width"),
+            )
+            if sampled
+            else None,
+            top_k=obj.get("top_k", 10),
+            num_workers=obj.get("num_workers", 1),
+            item_filter=ItemFilter(**obj.get("item_filter", {})),
+            **params,
+        )
+        if recommender.recommendation_cache is not None:
+            # the same lists requested again are served from the cache without training
+            recommender.recommend_top_k(
+                dataset=recommender.data_loader.load(),
+                top_k=obj.get("top_k", 10),
+                item_filter=ItemFilter(**obj.get("item_filter", {})),
+                **params,
+            )
+            logger.info(f"recommendation cache: {recommender.recommendation_cache.stats}")
+        logger.info(f"done {name} recommendation")
+
+    return click.Command(
+        name=spec.command_name,
+        callback=run,
+        params=[
+            click.Option(
+                [f"--{param.name}", param.name],
+                type=param.type,
+                default=param.default,
+                is_flag=param.type is bool,
+                show_default=True,
+                help=param.help,
+            )
+            for param in spec.params
+        ],
+    )
+
+
+class AlgorithmGroup(click.Group):
+    """`recommend` subcommands generated from the algorithm registry."""
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted(spec.command_name for spec in ALGORITHMS.values())
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        for spec in ALGORITHMS.values():
+            if spec.command_name == cmd_name:
+                return algorithm_command(spec)
+        return None
+
 
 @click.group()
 def cli():
@@ -18,9 +118,57 @@ def cli():
 
 
 @click.command()
-def download_command():
+@click.option(
+    "--url",
+    "url",
+    type=str,
+    default=None,
+    help="defaults to the MovieLens 10M archive",
+)
+@click.option(
+    "--num_connections",
+    "num_connections",
+    type=int,
+    default=8,
+)
+@click.option(
+    "--md5",
+    "md5",
+    type=str,
+    default=None,
+)
+def download_command(
+    url: Optional[str],
+    num_connections: int,
+    md5: Optional[str],
+):
+    log_startup("download-command")
+    from src.utils import download
+
     logger.info("download")
-    download.download()
+    download.download(
+        url=url or download.URL,
+        num_connections=num_connections,
+        md5=md5,
+    )
+
+
+@click.command()
+@click.option(
+    "--num_connections",
+    "num_connections",
+    type=int,
+    default=4,
+)
+def download_check_command(
+    num_connections: int,
+):
+    """download a sample archive from a local stand-in server, with and without range requests, and verify it."""
+    log_startup("download-check-command")
+    from src.utils.range_server import check_download
+
+    logger.info("download check")
+    check_download(num_connections=num_connections)
 
 
 @click.command()
@@ -30,12 +178,176 @@ def download_command():
     type=float,
     default=0.1,
 )
-def small_rating_command(rate: float = 0.1):
+@click.option(
+    "--mode",
+    "mode",
+    type=click.Choice(["row", "user", "item"]),
+    default="row",
+)
+@click.option(
+    "--seed",
+    "seed",
+    type=int,
+    default=0,
+)
+@click.option(
+    "--num_processes",
+    "num_processes",
+    type=int,
+    default=None,
+)
+def small_rating_command(
+    rate: float = 0.1,
+    mode: str = "row",
+    seed: int = 0,
+    num_processes: Optional[int] = None,
+):
+    log_startup("small-rating-command")
+    from src.utils import small_ratings
+
     logger.info("select ratings")
-    small_ratings.make_small_ratings(rate=rate)
+    small_ratings.make_small_ratings(
+        rate=rate,
+        mode=mode,
+        seed=seed,
+        num_processes=num_processes,
+    )
 
 
-@click.group()
+@click.command()
+@click.option(
+    "--algorithm",
+    "algorithm",
+    type=click.Choice(list(ALGORITHMS)),
+    required=True,
+)
+@click.option(
+    "--param",
+    "params",
+    type=str,
+    multiple=True,
+    help="name=value1,value2,... ; the grid is every combination of the given params",
+)
+@click.option(
+    "--metric",
+    "metric",
+    type=click.Choice(["rmse", "precision", "recall"]),
+    default="precision",
+)
+@click.option(
+    "--min_users",
+    "min_users",
+    type=int,
+    default=100,
+)
+@click.option(
+    "--max_users",
+    "max_users",
+    type=int,
+    default=1000,
+)
+@click.option(
+    "--eta",
+    "eta",
+    type=int,
+    default=3,
+)
+@click.option(
+    "--num_workers",
+    "num_workers",
+    type=int,
+    default=1,
+)
+@click.option(
+    "--num_test_items",
+    "num_test_items",
+    type=int,
+    default=5,
+)
+@click.option(
+    "--top_k",
+    "top_k",
+    type=int,
+    default=10,
+)
+def search_command(
+    algorithm: str,
+    params: Tuple[str, ...],
+    metric: str,
+    min_users: int,
+    max_users: int,
+    eta: int,
+    num_workers: int,
+    num_test_items: int,
+    top_k: int,
+):
+    log_startup("search-command")
+    from src.utils import successive_halving
+
+    logger.info("successive halving search")
+    successive_halving.search(
+        algorithm=algorithm,
+        params=list(params),
+        metric=metric,
+        min_users=min_users,
+        max_users=max_users,
+        eta=eta,
+        num_workers=num_workers,
+        num_test_items=num_test_items,
+        k=top_k,
+    )
+
+
+@click.command()
+@click.option(
+    "--num_users",
+    "num_users",
+    type=int,
+    default=1000,
+)
+@click.option(
+    "--num_test_items",
+    "num_test_items",
+    type=int,
+    default=5,
+)
+@click.option(
+    "--top_k",
+    "top_k",
+    type=int,
+    default=10,
+)
+@click.option(
+    "--shortlist_sizes",
+    "shortlist_sizes",
+    type=str,
+    default="10,20,50,100,200",
+    help="comma separated numbers of int8-retrieved candidates re-ranked exactly",
+)
+def quantization_benchmark_command(
+    num_users: int,
+    num_test_items: int,
+    top_k: int,
+    shortlist_sizes: str,
+):
+    """recall@k, time per user and factor memory of quantized item2vec scoring against exact float32 scoring."""
+    log_startup("quantization-benchmark-command")
+    from src.algorithms.item2vec_recommender import Item2VecRecommender
+
+    logger.info("quantization benchmark")
+    recommender = Item2VecRecommender(
+        num_users=num_users,
+        num_test_items=num_test_items,
+    )
+    for result in recommender.benchmark_quantization(
+        dataset=recommender.data_loader.load(),
+        k=top_k,
+        shortlist_sizes=[int(size) for size in shortlist_sizes.split(",")],
+    ):
+        logger.info(result)
+
+
+@click.group(cls=AlgorithmGroup)
 @click.option(
     "--num_users",
     "num_users",
@@ -54,125 +366,267 @@ def small_rating_command(rate: float = 0.1):
     type=int,
     default=10,
 )
+@click.option(
+    "--memory_budget",
+    "memory_budget",
+    type=str,
+    default=None,
+    help="e.g. 512M or 4G; process ratings and score users in blocks that fit this budget",
+)
+@click.option(
+    "--num_workers",
+    "num_workers",
+    type=int,
+    default=1,
+    help="threads for overlapping stages: movies and tags parse while ratings load, shards are evaluated while scoring",
+)
+@click.option(
+    "--eval_sample_users",
+    "eval_sample_users",
+    type=int,
+    default=None,
+    help="evaluate a stratified sample of at most this many users, with bootstrap confidence intervals",
+)
+@click.option(
+    "--eval_max_ci_width",
+    "eval_max_ci_width",
+    type=float,
+    default=None,
+    help="stop sampled evaluation once every confidence interval is narrower than this",
+)
+@click.option(
+    "--cache_max_entries",
+    "cache_max_entries",
+    type=int,
+    default=None,
+    help="cache up to this many top k lists; the lists are then requested again and served from the cache",
+)
+@click.option(
+    "--cache_ttl",
+    "cache_ttl",
+    type=float,
+    default=None,
+    help="seconds a cached list stays valid",
+)
+@click.option(
+    "--include_genres",
+    "include_genres",
+    type=str,
+    default="",
+    help="comma separated; keep items with any of these genres",
+)
+@click.option(
+    "--exclude_genres",
+    "exclude_genres",
+    type=str,
+    default="",
+    help="comma separated; drop items with any of these genres",
+)
+@click.option(
+    "--include_tags",
+    "include_tags",
+    type=str,
+    default="",
+    help="comma separated; keep items with any of these tags",
+)
+@click.option(
+    "--exclude_tags",
+    "exclude_tags",
+    type=str,
+    default="",
+    help="comma separated; drop items with any of these tags",
+)
+@click.option(
+    "--min_year",
+    "min_year",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--max_year",
+    "max_year",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--blocked_items",
+    "blocked_items",
+    type=str,
+    default="",
+    help="comma separated movie ids that are never recommended",
+)
 @click.pass_context
 def recommend(
     ctx,
     num_users: int,
     num_test_items: int,
     top_k: int,
+    memory_budget: Optional[str],
+    num_workers: int,
+    eval_sample_users: Optional[int],
+    eval_max_ci_width: Optional[float],
+    cache_max_entries: Optional[int],
+    cache_ttl: Optional[float],
+    include_genres: str,
+    exclude_genres: str,
+    include_tags: str,
+    exclude_tags: str,
+    min_year: Optional[int],
+    max_year: Optional[int],
+    blocked_items: str,
 ):
+    def split(values: str) -> Tuple[str, ...]:
+        return tuple(value.strip() for value in values.split(",") if value.strip())
+
     ctx.obj = dict(
         num_users=num_users,
         num_test_items=num_test_items,
         top_k=top_k,
+        memory_budget=memory_budget,
+        num_workers=num_workers,
+        eval_sample_users=eval_sample_users,
+        eval_max_ci_width=eval_max_ci_width,
+        cache_max_entries=cache_max_entries,
+        cache_ttl=cache_ttl,
+        item_filter=dict(
+            include_genres=split(include_genres),
+            exclude_genres=split(exclude_genres),
+            include_tags=split(include_tags),
+            exclude_tags=split(exclude_tags),
+            min_year=min_year,
+            max_year=max_year,
+            blocked_items=tuple(int(item) for item in split(blocked_items)),
+        ),
     )
 
 
 @click.command()
-@click.pass_obj
-def random_recommend(obj: Dict[str, Any]):
-    logger.info("random recommendation")
-    recommender = RandomRecommender(
-        num_users=obj.get("num_users", 1000),
-        num_test_items=obj.get("num_test_items", 5),
-    )
-    recommender.run_sample(k=obj.get("top_k", 10))
-    logger.info("done random recommendation")
-
-
-@click.command()
-@click.pass_obj
 @click.option(
-    "--minimum_num_rating",
-    "minimum_num_rating",
+    "--algorithm",
+    "algorithm",
+    type=click.Choice(list(ALGORITHMS)),
+    required=True,
+)
+@click.option(
+    "--num_users",
+    "num_users",
     type=int,
-    default=200,
+    default=1000,
 )
-def popularity_recommend(
-    obj: Dict[str, Any],
-    minimum_num_rating: int,
-):
-    logger.info("popularity recommendation")
-    recommender = PopularityRecommender(
-        num_users=obj.get("num_users", 1000),
-        num_test_items=obj.get("num_test_items", 5),
-    )
-    recommender.run_sample(
-        k=obj.get("top_k", 10),
-        minimum_num_rating=minimum_num_rating,
-    )
-    logger.info("done popularity recommendation")
-
-
-@click.command()
-@click.pass_obj
 @click.option(
-    "--min_support",
-    "min_support",
-    type=float,
-    default=0.1,
+    "--num_fold_in_users",
+    "num_fold_in_users",
+    type=int,
+    default=50,
+    help="training users folded back in and compared with their recommend lists",
 )
 @click.option(
-    "--min_threshold",
-    "min_threshold",
-    type=float,
-    default=1.0,
+    "--top_k",
+    "top_k",
+    type=int,
+    default=10,
+)
+@click.option(
+    "--exclude_genres",
+    "exclude_genres",
+    type=str,
+    default="",
+    help="comma separated; drop items with any of these genres",
 )
-def association_recommend(
-    obj: Dict[str, Any],
-    min_support: float,
-    min_threshold: float,
+@click.option(
+    "--blocked_items",
+    "blocked_items",
+    type=str,
+    default="",
+    help="comma separated movie ids that are never recommended",
+)
+def fold_in_check_command(
+    algorithm: str,
+    num_users: int,
+    num_fold_in_users: int,
+    top_k: int,
+    exclude_genres: str,
+    blocked_items: str,
 ):
-    logger.info("association recommendation")
-    recommender = AssociationRecommender(
-        num_users=obj.get("num_users", 1000),
-        num_test_items=obj.get("num_test_items", 5),
-    )
-    recommender.run_sample(
-        k=obj.get("top_k", 10),
-        min_support=min_support,
-        min_threshold=min_threshold,
-    )
-    logger.info("done association recommendation")
+    """check that folding training users back in reproduces their recommend lists, filters included."""
+    log_startup("fold-in-check-command")
+    from src.models.item_filters import ItemFilter
 
+    spec = ALGORITHMS[algorithm]
+    recommender_class = spec.load()
+    if not recommender_class.supports_fold_in:
+        raise click.ClickException(f"{algorithm} does not support fold-in")
 
-@click.command()
-@click.pass_obj
-def umcf_recommend(obj: Dict[str, Any]):
-    logger.info("umcf recommendation")
-    recommender = UMCFRecommender(
-        num_users=obj.get("num_users", 1000),
-        num_test_items=obj.get("num_test_items", 5),
-    )
-    recommender.run_sample(
-        k=obj.get("top_k", 10),
-        top_k=obj.get("top_k", 10),
+    logger.info(f"{algorithm} fold-in check")
+    recommender = recommender_class(num_users=num_users)
+    different = recommender.check_fold_in(
+        dataset=recommender.data_loader.load(),
+        num_users=num_fold_in_users,
+        top_k=top_k,
+        item_filter=ItemFilter(
+            exclude_genres=tuple(genre.strip() for genre in exclude_genres.split(",") if genre.strip()),
+            blocked_items=tuple(int(item) for item in blocked_items.split(",") if item.strip()),
+        ),
+        **spec.defaults(),
     )
-    logger.info("done umcf recommendation")
+    if different:
+        raise click.ClickException(f"fold-in lists differ from recommend for users {different}")
 
 
 @click.command()
-@click.pass_obj
-def regression_recommend(obj: Dict[str, Any]):
-    logger.info("regression recommendation")
-    recommender = RegressionRecommendation(
-        num_users=obj.get("num_users", 1000),
-        num_test_items=obj.get("num_test_items", 5),
-    )
-    recommender.run_sample(
-        k=obj.get("top_k", 10),
-        top_k=obj.get("top_k", 10),
-    )
-    logger.info("done regression recommendation")
+@click.option(
+    "--budget_ms",
+    "budget_ms",
+    type=float,
+    default=STARTUP_BUDGET_MS,
+)
+@click.option(
+    "--repeat",
+    "repeat",
+    type=int,
+    default=3,
+)
+def startup_time_command(
+    budget_ms: float,
+    repeat: int,
+):
+    """time `--help` of every subcommand in a fresh interpreter; fails if any exceeds the budget."""
+    commands = [
+        ["download-command"],
+        ["download-check-command"],
+        ["small-rating-command"],
+        ["search-command"],
+        ["quantization-benchmark-command"],
+        ["fold-in-check-command"],
+        ["recommend"],
+    ]
+    commands += [["recommend", spec.command_name] for spec in ALGORITHMS.values()]
+    over_budget = []
+    for command in commands:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-m", "src.main", *command, "--help"],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            timings.append((time.perf_counter() - started) * 1000)
+        best_ms = min(timings)
+        logger.info(f"{' '.join(command)}: {best_ms:.0f} ms")
+        if best_ms > budget_ms:
+            over_budget.append(" ".join(command))
+    if over_budget:
+        raise click.ClickException(f"over the {budget_ms:.0f} ms startup budget: {', '.join(over_budget)}")
 
 
 if __name__ == "__main__":
     cli.add_command(download_command)
+    cli.add_command(download_check_command)
     cli.add_command(small_rating_command)
-    recommend.add_command(random_recommend)
-    recommend.add_command(popularity_recommend)
-    recommend.add_command(association_recommend)
-    recommend.add_command(umcf_recommend)
-    recommend.add_command(regression_recommend)
+    cli.add_command(search_command)
+    cli.add_command(quantization_benchmark_command)
+    cli.add_command(fold_in_check_command)
+    cli.add_command(startup_time_command)
     cli.add_command(recommend)
     cli()
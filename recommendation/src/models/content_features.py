@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+
+@dataclass(frozen=True)
+class MultiHotFeatures:
+    """item x vocabulary sparse matrix; rows are aligned with Dataset.item_content."""
+
+    matrix: sparse.csr_matrix
+    vocabulary: List[str]
+
+
+@dataclass(frozen=True)
+class ContentFeatures:
+    """item x feature CSR matrix of genre flags and TF-IDF weighted tags."""
+
+    matrix: sparse.csr_matrix
+    vocabulary: List[str]
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=self.matrix.shape,
+            vocabulary=np.array(self.vocabulary, dtype=object),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "ContentFeatures":
+        with np.load(path, allow_pickle=True) as f:
+            matrix = sparse.csr_matrix(
+                (f["data"], f["indices"], f["indptr"]),
+                shape=tuple(f["shape"]),
+            )
+            return cls(
+                matrix=matrix,
+                vocabulary=f["vocabulary"].tolist(),
+            )
+
+
+def make_multi_hot(
+    item_indexes: np.ndarray,
+    values: pd.Series,
+    num_items: int,
+) -> MultiHotFeatures:
+    codes, vocabulary = pd.factorize(values, sort=True)
+    matrix = sparse.csr_matrix(
+        (
+            np.ones(len(codes), dtype=np.float32),
+            (item_indexes, codes),
+        ),
+        shape=(num_items, len(vocabulary)),
+    )
+    matrix.sum_duplicates()
+    return MultiHotFeatures(
+        matrix=matrix,
+        vocabulary=vocabulary.tolist(),
+    )
+
+
+def tfidf(counts: sparse.csr_matrix) -> sparse.csr_matrix:
+    num_items = counts.shape[0]
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((1 + num_items) / (1 + document_frequency)) + 1
+    weighted = counts.copy().astype(np.float32)
+    weighted.data = np.log1p(weighted.data) * idf[weighted.indices].astype(np.float32)
+    return normalize(weighted, norm="l2", copy=False)
+
+
+def build_content_features(
+    genre_features: MultiHotFeatures,
+    tag_features: MultiHotFeatures,
+    genre_weight: float = 1.0,
+    tag_weight: float = 1.0,
+    min_tag_items: int = 2,
+) -> ContentFeatures:
+    genre_matrix = normalize(
+        (genre_features.matrix > 0).astype(np.float32),
+        norm="l2",
+    )
+
+    tag_items = np.bincount(tag_features.matrix.indices, minlength=len(tag_features.vocabulary))
+    kept_tags = np.flatnonzero(tag_items >= min_tag_items)
+    tag_matrix = tfidf(tag_features.matrix[:, kept_tags].tocsr())
+
+    matrix = sparse.hstack(
+        [
+            genre_matrix * genre_weight,
+            tag_matrix * tag_weight,
+        ],
+        format="csr",
+        dtype=np.float32,
+    )
+    vocabulary = [f"genre:{genre}" for genre in genre_features.vocabulary] + [
+        f"tag:{tag_features.vocabulary[i]}" for i in kept_tags
+    ]
+    return ContentFeatures(
+        matrix=matrix,
+        vocabulary=vocabulary,
+    )
@@ -1,10 +1,17 @@
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from enum import Enum
-from typing import Dict, List, Tuple
+from functools import cached_property, partial
+from typing import Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
+from src.models.content_features import ContentFeatures, MultiHotFeatures, build_content_features, make_multi_hot
+from src.models.item_filters import ItemBitmapIndex, parse_years
 from src.utils.logger import configure_logger
+from src.utils.memory import MemoryBudget
+from src.utils.rating_cache import RATING_DTYPES, cache_path, load_ratings
+from src.utils.stage_graph import StageGraph
 
 
 class Ratings(Enum):
@@ -12,12 +19,80 @@ class Ratings(Enum):
     SmallRating = "small_rating_0.1.dat"
 
 
+def rating_stats(ratings: pd.DataFrame, key: str) -> pd.DataFrame:
+    """count, mean, min and max rating per user_id or movie_id, indexed by key."""
+    return ratings.groupby(key).rating.agg(["count", "mean", "min", "max"])
+
+
 @dataclass(frozen=True)
 class Dataset:
     train: pd.DataFrame
     test: pd.DataFrame
     test_user2items: Dict[int, List[int]]
     item_content: pd.DataFrame
+    genre_features: MultiHotFeatures
+    tag_features: MultiHotFeatures
+
+    @cached_property
+    def content_features(self) -> ContentFeatures:
+        return build_content_features(
+            genre_features=self.genre_features,
+            tag_features=self.tag_features,
+        )
+
+    @cached_property
+    def user_stats(self) -> pd.DataFrame:
+        return rating_stats(self.train, "user_id")
+
+    @cached_property
+    def movie_stats(self) -> pd.DataFrame:
+        return rating_stats(self.train, "movie_id")
+
+    @cached_property
+    def item_bitmaps(self) -> ItemBitmapIndex:
+        return self.build_item_bitmaps(self.item_content, self.genre_features, self.tag_features)
+
+    @staticmethod
+    def build_item_bitmaps(
+        item_content: pd.DataFrame,
+        genre_features: MultiHotFeatures,
+        tag_features: MultiHotFeatures,
+    ) -> ItemBitmapIndex:
+        return ItemBitmapIndex(
+            item_ids=item_content.movie_id.values,
+            years=parse_years(item_content.title),
+            genre_features=genre_features,
+            tag_features=tag_features,
+        )
+
+    def item_indexes(self, movie_ids: Sequence[int]) -> np.ndarray:
+        return np.searchsorted(self.item_content.movie_id.values, movie_ids)
+
+    def join_item_content(
+        self,
+        ratings: pd.DataFrame,
+        columns: Sequence[str] = ("title",),
+    ) -> pd.DataFrame:
+        return ratings.merge(
+            self.item_content[["movie_id", *columns]],
+            on="movie_id",
+            how="left",
+        )
+
+    def head_users(self, num_users: int) -> "Dataset":
+        """
+        The split of the num_users smallest user ids. Ratings are split per user, so this equals what DataLoader
+        loads for num_users.
+        """
+        user_ids = np.union1d(self.train.user_id.unique(), self.test.user_id.unique())[:num_users]
+        return replace(
+            self,
+            train=self.train[self.train.user_id.isin(user_ids)],
+            test=self.test[self.test.user_id.isin(user_ids)],
+            test_user2items={
+                user_id: items for user_id, items in self.test_user2items.items() if user_id <= user_ids[-1]
+            },
+        )
 
 
 @dataclass(frozen=True)
@@ -26,48 +101,131 @@ class RecommendResult:
     user2items: Dict[int, List[int]]
 
 
+def read_item_content(data_path: str) -> Tuple[pd.DataFrame, MultiHotFeatures, MultiHotFeatures]:
+    """
+    movies (id and title, sorted by id) with their genre and tag features, from movies.dat and tags.dat.
+    A module level function so DataLoader can run it in a worker process.
+    """
+    m_cols = ["movie_id", "title", "genre"]
+    movies = pd.read_csv(
+        os.path.join(data_path, "movies.dat"),
+        names=m_cols,
+        sep="::",
+        encoding="latin-1",
+        engine="python",
+        dtype={"movie_id": np.int32},
+    )
+    movies = movies.sort_values("movie_id").reset_index(drop=True)
+    movie_indexes = pd.Series(
+        np.arange(len(movies)),
+        index=movies.movie_id,
+    )
+
+    movie_genres = movies.genre.str.split("|").explode()
+    genre_features = make_multi_hot(
+        item_indexes=movie_genres.index.values,
+        values=movie_genres,
+        num_items=len(movies),
+    )
+
+    t_cols = ["user_id", "movie_id", "tag", "timestamp"]
+    user_tagged_movies = pd.read_csv(
+        os.path.join(data_path, "tags.dat"),
+        names=t_cols,
+        usecols=["movie_id", "tag"],
+        sep="::",
+        engine="python",
+        dtype={"movie_id": np.int32, "tag": str},
+    )
+
+    user_tagged_movies["tag"] = user_tagged_movies["tag"].str.lower()
+    user_tagged_movies = user_tagged_movies[
+        user_tagged_movies.tag.notnull() & user_tagged_movies.movie_id.isin(movie_indexes.index)
+    ]
+    tag_features = make_multi_hot(
+        item_indexes=movie_indexes[user_tagged_movies.movie_id].values,
+        values=user_tagged_movies.tag,
+        num_items=len(movies),
+    )
+
+    movies = movies[["movie_id", "title"]]
+    return movies, genre_features, tag_features
+
+
 class DataLoader(object):
     def __init__(
         self,
         num_users: int = 1000,
         num_test_items: int = 5,
         data_path: str = "data/ml-10M100K/",
+        memory_budget: Optional[MemoryBudget] = None,
     ):
         self.logger = configure_logger(__name__)
         self.num_users = num_users
         self.num_test_items = num_test_items
         self.data_path = data_path
+        self.memory_budget = memory_budget or MemoryBudget()
         self.logger.info("initialized data loader")
 
-    def load(self) -> Dataset:
+    def load(self, num_workers: int = 1) -> Dataset:
+        """
+        Loading runs as a stage graph. With num_workers > 1 the stages overlap: movies and tags are parsed in a
+        worker process while ratings load, and content features and item bitmaps are built while ratings are split.
+        Per-user and per-movie rating stats of the train split are built alongside test_user2items.
+        """
         self.logger.info(f"start loading data: {self.data_path}")
-        ratings, movie_content = self._load()
-        movielens_train, movielens_test = self._split_data(ratings)
-
-        movielens_test_user2items = (
-            movielens_test[movielens_test.rating >= 4].groupby("user_id").agg({"movie_id": list})["movie_id"].to_dict()
-        )
+        graph = StageGraph(num_workers=num_workers)
+        graph.add("item_content", partial(read_item_content, self.data_path), process=True)
+        graph.add("raw_ratings", self._read_ratings)
+        graph.add("ratings", self._known_movie_ratings, ["raw_ratings", "item_content"])
+        graph.add("split", self._split_data, ["ratings"])
+        graph.add("test_user2items", self._test_user2items, ["split"])
+        graph.add("user_stats", lambda split: rating_stats(split[0], "user_id"), ["split"])
+        graph.add("movie_stats", lambda split: rating_stats(split[0], "movie_id"), ["split"])
+        if num_workers > 1:
+            graph.add("content_features", lambda content: build_content_features(*content[1:]), ["item_content"])
+            graph.add("item_bitmaps", lambda content: Dataset.build_item_bitmaps(*content), ["item_content"])
+        results = graph.run()
+        graph.log_timings("load")
 
+        movie_content, genre_features, tag_features = results["item_content"]
+        movielens_train, movielens_test = results["split"]
         dataset = Dataset(
             train=movielens_train,
             test=movielens_test,
-            test_user2items=movielens_test_user2items,
+            test_user2items=results["test_user2items"],
             item_content=movie_content,
+            genre_features=genre_features,
+            tag_features=tag_features,
         )
+        # cached_property reads precomputed values from the instance dict
+        for name in ["content_features", "item_bitmaps", "user_stats", "movie_stats"]:
+            if name in results:
+                dataset.__dict__[name] = results[name]
         self.logger.info(f"done loading data: {self.data_path}")
         return dataset
 
+    def _test_user2items(
+        self,
+        split: Tuple[pd.DataFrame, pd.DataFrame],
+    ) -> Dict[int, List[int]]:
+        movielens_test = split[1]
+        test_user2items: Dict[int, List[int]] = (
+            movielens_test[movielens_test.rating >= 4].groupby("user_id").agg({"movie_id": list})["movie_id"].to_dict()
+        )
+        return test_user2items
+
     def _split_data(
         self,
         movielens: pd.DataFrame,
     ) -> Tuple[pd.DataFrame, pd.DataFrame]:
         self.logger.info("split dataset...")
-        movielens["rating_order"] = movielens.groupby("user_id")["timestamp"].rank(
+        rating_order = movielens.groupby("user_id")["timestamp"].rank(
             ascending=False,
             method="first",
         )
-        movielens_train = movielens[movielens["rating_order"] > self.num_test_items]
-        movielens_test = movielens[movielens["rating_order"] <= self.num_test_items]
+        movielens_train = movielens[rating_order > self.num_test_items]
+        movielens_test = movielens[rating_order <= self.num_test_items]
 
         self.logger.info(
             f"""
@@ -78,53 +236,68 @@ splitted data:
         )
         return movielens_train, movielens_test
 
-    def _load(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        m_cols = ["movie_id", "title", "genre"]
-        self.logger.info("read movies.dat...")
-        movies = pd.read_csv(
-            os.path.join(self.data_path, "movies.dat"),
-            names=m_cols,
-            sep="::",
-            encoding="latin-1",
-            engine="python",
-        )
-        movies["genre"] = movies.genre.apply(lambda x: x.split("|"))
-
-        t_cols = ["user_id", "movie_id", "tag", "timestamp"]
-        self.logger.info("read tags.dat...")
-        user_tagged_movies = pd.read_csv(
-            os.path.join(self.data_path, "tags.dat"),
-            names=t_cols,
-            sep="::",
-            engine="python",
-        )
-
-        user_tagged_movies["tag"] = user_tagged_movies["tag"].str.lower()
-        movie_tags = user_tagged_movies.groupby("movie_id").agg({"tag": list})
-
-        movies = movies.merge(movie_tags, on="movie_id", how="left")
-
+    def _read_ratings(self) -> pd.DataFrame:
+        """ratings of the num_users smallest user ids, from the rating cache when it is up to date."""
         r_cols = ["user_id", "movie_id", "rating", "timestamp"]
 
         rating_file = Ratings.Rating.value
         if os.getenv("RATING") == Ratings.SmallRating.name:
             rating_file = Ratings.SmallRating.value
-        self.logger.info(f"read {rating_file}...")
-        ratings = pd.read_csv(
-            os.path.join(self.data_path, rating_file),
-            names=r_cols,
-            sep="::",
-            engine="python",
-        )
+        rating_path = os.path.join(self.data_path, rating_file)
+        rating_cache = cache_path(rating_path)
+        if os.path.exists(rating_cache) and (
+            not os.path.exists(rating_path) or os.path.getmtime(rating_cache) >= os.path.getmtime(rating_path)
+        ):
+            self.logger.info(f"read {rating_cache}...")
+            ratings = load_ratings(rating_cache, num_users=self.num_users)
+        elif self.memory_budget.limit is None:
+            self.logger.info(f"read {rating_file}...")
+            ratings = pd.read_csv(
+                rating_path,
+                names=r_cols,
+                sep="::",
+                engine="python",
+                dtype=RATING_DTYPES,
+            )
+        else:
+            ratings = self._read_ratings_in_chunks(rating_path)
 
         valid_user_ids = sorted(ratings.user_id.unique())[: self.num_users]
-        ratings = ratings[ratings.user_id <= max(valid_user_ids)]
-
-        self.logger.info("merge data...")
-        movielens_ratings = ratings.merge(
-            movies,
-            on="movie_id",
-        )
+        return ratings[ratings.user_id <= max(valid_user_ids)]
 
+    def _known_movie_ratings(
+        self,
+        ratings: pd.DataFrame,
+        item_content: Tuple[pd.DataFrame, MultiHotFeatures, MultiHotFeatures],
+    ) -> pd.DataFrame:
+        ratings = ratings[ratings.movie_id.isin(item_content[0].movie_id)]
+        self.logger.info(f"ratings use {ratings.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MiB")
         self.logger.info("done loading data")
-        return movielens_ratings, movies
+        return ratings
+
+    def _read_ratings_in_chunks(
+        self,
+        rating_path: str,
+    ) -> pd.DataFrame:
+        """
+        Read ratings chunk by chunk, keeping only rows of the num_users smallest user ids seen so far,
+        so no more than one chunk beyond the kept ratings is held.
+        """
+        chunk_rows = self.memory_budget.block_rows(bytes_per_row=256, default=1_000_000)
+        self.logger.info(f"read {rating_path} in chunks of {chunk_rows} rows...")
+
+        user_ids = np.empty(0, dtype=np.int32)
+        chunks: List[pd.DataFrame] = []
+        for chunk in pd.read_csv(
+            rating_path,
+            names=list(RATING_DTYPES.keys()),
+            sep="::",
+            engine="python",
+            dtype=RATING_DTYPES,
+            chunksize=chunk_rows,
+        ):
+            user_ids = np.union1d(user_ids, chunk.user_id.unique())[: self.num_users]
+            cutoff = user_ids.max()
+            chunks = [c[c.user_id <= cutoff] for c in chunks]
+            chunks.append(chunk[chunk.user_id <= cutoff])
+        return pd.concat(chunks, ignore_index=True)
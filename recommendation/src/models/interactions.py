@@ -0,0 +1,62 @@
+import hashlib
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def rating_matrix(
+    ratings: pd.DataFrame,
+    user_ids: np.ndarray,
+    item_ids: np.ndarray,
+    values: Optional[np.ndarray] = None,
+) -> sparse.csr_matrix:
+    """user x item CSR matrix; user_ids and item_ids must be sorted and contain every id in ratings."""
+    if values is None:
+        values = ratings.rating.values
+    return sparse.csr_matrix(
+        (
+            np.asarray(values, dtype=np.float32),
+            (
+                np.searchsorted(user_ids, ratings.user_id.values),
+                np.searchsorted(item_ids, ratings.movie_id.values),
+            ),
+        ),
+        shape=(len(user_ids), len(item_ids)),
+    )
+
+
+def recent_items(
+    ratings: pd.DataFrame,
+    num_recent: int = 5,
+    min_rating: float = 4,
+) -> pd.DataFrame:
+    """last num_recent ratings >= min_rating of every user, in timestamp order."""
+    high_rating = ratings[ratings.rating >= min_rating].sort_values(["user_id", "timestamp"], kind="stable")
+    from_last = high_rating.groupby("user_id").cumcount(ascending=False)
+    return high_rating[from_last < num_recent]
+
+
+def index_with_default(
+    ids: np.ndarray,
+    known_ids: np.ndarray,
+) -> np.ndarray:
+    """positions of ids in the sorted known_ids; unknown ids map to len(known_ids)."""
+    ids = np.asarray(ids)
+    if len(known_ids) == 0:
+        return np.zeros(len(ids), dtype=np.int64)
+    indexes = np.minimum(np.searchsorted(known_ids, ids), len(known_ids) - 1)
+    return np.where(known_ids[indexes] == ids, indexes, len(known_ids)).astype(np.int64)
+
+
+def ratings_fingerprint(
+    ratings: pd.DataFrame,
+    *params: Any,
+) -> str:
+    """hex digest of the (user, movie, rating, timestamp) rows of ratings and params; tells snapshots built from other data apart."""
+    digest = hashlib.sha1(repr(params).encode())
+    digest.update(
+        pd.util.hash_pandas_object(ratings[["user_id", "movie_id", "rating", "timestamp"]], index=False).values
+    )
+    return digest.hexdigest()
@@ -0,0 +1,126 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from src.models.content_features import MultiHotFeatures
+
+
+@dataclass(frozen=True)
+class ItemFilter:
+    """
+    Business rules on candidate items. Hashable, so it can be part of a recommendation cache key.
+    An item passes if it has any of include_genres / include_tags (when given), none of the excluded ones,
+    a release year within [min_year, max_year] and is not blocked.
+    """
+
+    include_genres: Tuple[str, ...] = ()
+    exclude_genres: Tuple[str, ...] = ()
+    include_tags: Tuple[str, ...] = ()
+    exclude_tags: Tuple[str, ...] = ()
+    min_year: Optional[int] = None
+    max_year: Optional[int] = None
+    blocked_items: Tuple[int, ...] = ()
+
+    def is_empty(self) -> bool:
+        return self == ItemFilter()
+
+
+def parse_years(titles: pd.Series) -> np.ndarray:
+    """release year from titles like "Toy Story (1995)"; 0 when the title has none."""
+    years = titles.str.extract(r"\((\d{4})\)\s*$", expand=False)
+    return np.asarray(years.fillna(0).astype(np.int32).values)
+
+
+class ItemBitmapIndex(object):
+    """
+    Packed bitmaps (np.packbits, 1 bit per item) of every genre and tag over the items of Dataset.item_content,
+    plus their release years. Filters are evaluated with bitwise operations on the bitmaps.
+    """
+
+    def __init__(
+        self,
+        item_ids: np.ndarray,
+        years: np.ndarray,
+        genre_features: MultiHotFeatures,
+        tag_features: MultiHotFeatures,
+    ):
+        self.item_ids = item_ids
+        self.years = years
+        self.num_items = len(item_ids)
+        self.genre_bitmaps = self._bitmaps(genre_features)
+        self.tag_bitmaps = self._bitmaps(tag_features)
+
+    def _bitmaps(self, features: MultiHotFeatures) -> Dict[str, np.ndarray]:
+        columns = features.matrix.tocsc()
+        bitmaps = {}
+        for j, value in enumerate(features.vocabulary):
+            flags = np.zeros(self.num_items, dtype=bool)
+            flags[columns.indices[columns.indptr[j] : columns.indptr[j + 1]]] = True
+            bitmaps[value] = np.packbits(flags)
+        return bitmaps
+
+    def _any_of(
+        self,
+        bitmaps: Dict[str, np.ndarray],
+        values: Iterable[str],
+    ) -> np.ndarray:
+        bitmap = np.zeros((self.num_items + 7) // 8, dtype=np.uint8)
+        for value in values:
+            if value in bitmaps:
+                bitmap |= bitmaps[value]
+        return bitmap
+
+    def bitmap(self, item_filter: ItemFilter) -> np.ndarray:
+        """packed bitmap of the items passing item_filter."""
+        bitmap = np.packbits(np.ones(self.num_items, dtype=bool))
+        if item_filter.include_genres:
+            bitmap &= self._any_of(self.genre_bitmaps, item_filter.include_genres)
+        if item_filter.include_tags:
+            bitmap &= self._any_of(self.tag_bitmaps, [tag.lower() for tag in item_filter.include_tags])
+        bitmap &= ~self._any_of(self.genre_bitmaps, item_filter.exclude_genres)
+        bitmap &= ~self._any_of(self.tag_bitmaps, [tag.lower() for tag in item_filter.exclude_tags])
+        if item_filter.min_year is not None or item_filter.max_year is not None:
+            in_range = (self.years >= (item_filter.min_year or 0)) & (self.years <= (item_filter.max_year or 9999))
+            bitmap &= np.packbits(in_range)
+        if item_filter.blocked_items:
+            blocked = np.isin(self.item_ids, item_filter.blocked_items)
+            bitmap &= ~np.packbits(blocked)
+        return bitmap
+
+    def mask(
+        self,
+        item_filter: ItemFilter,
+        item_ids: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """boolean mask of the items passing item_filter, over item_ids (sorted) or all indexed items."""
+        mask = np.unpackbits(self.bitmap(item_filter), count=self.num_items).astype(bool)
+        if item_ids is None:
+            return mask
+        # items missing from the index (no content) only pass an empty filter
+        indexes = np.minimum(np.searchsorted(self.item_ids, item_ids), self.num_items - 1)
+        known = self.item_ids[indexes] == item_ids
+        return np.where(known, mask[indexes], item_filter.is_empty())
+
+
+def exclusion_matrix(
+    user_ids: np.ndarray,
+    item_ids: np.ndarray,
+    user_exclusions: Dict[int, List[int]],
+) -> sparse.csr_matrix:
+    """user x item CSR matrix of per-user excluded items; users and items must be sorted, unknown ids are dropped."""
+    pairs = [(user_id, item_id) for user_id, items in user_exclusions.items() for item_id in items]
+    if not pairs:
+        return sparse.csr_matrix((len(user_ids), len(item_ids)), dtype=np.float32)
+    pair_users, pair_items = np.array(pairs, dtype=np.int64).T
+    user_indexes = np.minimum(np.searchsorted(user_ids, pair_users), len(user_ids) - 1)
+    item_indexes = np.minimum(np.searchsorted(item_ids, pair_items), len(item_ids) - 1)
+    known = (user_ids[user_indexes] == pair_users) & (item_ids[item_indexes] == pair_items)
+    return sparse.csr_matrix(
+        (
+            np.ones(known.sum(), dtype=np.float32),
+            (user_indexes[known], item_indexes[known]),
+        ),
+        shape=(len(user_ids), len(item_ids)),
+    )
@@ -1,5 +1,7 @@
+import itertools
+import threading
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 
 import numpy as np
 from sklearn.metrics import mean_squared_error
@@ -30,6 +32,136 @@ Precision@K={self.precision_at_k.precision:.3f}
 Recall@K={self.recall_at_k.recall:.3f}"""
 
 
+@dataclass(frozen=True)
+class ConfidenceInterval:
+    low: float
+    high: float
+
+    @property
+    def width(self) -> float:
+        return self.high - self.low
+
+
+@dataclass(frozen=True)
+class SampledEvaluation:
+    """
+    Evaluate a sample of users instead of all of them.
+    Users are added in batches of batch_size, in an order that keeps every prefix stratified by user activity,
+    until sample_size users are evaluated or every confidence interval is narrower than max_ci_width.
+    """
+
+    sample_size: Optional[int] = None
+    batch_size: int = 1000
+    num_bootstrap: int = 200
+    confidence: float = 0.95
+    max_ci_width: Optional[float] = None
+    num_strata: int = 4
+    seed: int = 0
+
+
+@dataclass(frozen=True)
+class SampledMetrics:
+    metrics: Metrics
+    rmse_ci: ConfidenceInterval
+    precision_ci: ConfidenceInterval
+    recall_ci: ConfidenceInterval
+    num_sampled_users: int
+    num_users: int
+
+    def __repr__(self):
+        return f"""rmse={self.metrics.rmse:.3f} [{self.rmse_ci.low:.3f}, {self.rmse_ci.high:.3f}]
+Precision@K={self.metrics.precision_at_k.precision:.3f} [{self.precision_ci.low:.3f}, {self.precision_ci.high:.3f}]
+Recall@K={self.metrics.recall_at_k.recall:.3f} [{self.recall_ci.low:.3f}, {self.recall_ci.high:.3f}]
+users={self.num_sampled_users}/{self.num_users}"""
+
+
+def _hits_per_user(
+    true_user2items: Dict[int, List[int]],
+    pred_user2items: Dict[int, List[int]],
+    user_ids: Sequence[int],
+    k: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """number of true items among the top k of every user (no list counts as empty), and the number of true items."""
+    true_lists = [true_user2items[user_id] for user_id in user_ids]
+    pred_lists = [pred_user2items.get(user_id, [])[:k] for user_id in user_ids]
+    true_lengths = np.array([len(items) for items in true_lists], dtype=np.int64)
+    pred_lengths = np.array([len(items) for items in pred_lists], dtype=np.int64)
+    true_items = np.fromiter(itertools.chain.from_iterable(true_lists), dtype=np.int64, count=true_lengths.sum())
+    pred_items = np.fromiter(itertools.chain.from_iterable(pred_lists), dtype=np.int64, count=pred_lengths.sum())
+
+    # (user position, item) pairs encoded as one int64 so membership is a single np.isin
+    num_items = int(max(true_items.max(initial=0), pred_items.max(initial=0))) + 1
+    true_keys = np.unique(np.repeat(np.arange(len(user_ids)), true_lengths) * num_items + true_items)
+    pred_keys = np.unique(np.repeat(np.arange(len(user_ids)), pred_lengths) * num_items + pred_items)
+    hit_keys = pred_keys[np.isin(pred_keys, true_keys, assume_unique=True)]
+    return np.bincount(hit_keys // num_items, minlength=len(user_ids)), true_lengths
+
+
+def _stratified_order(
+    activity: np.ndarray,
+    num_strata: int,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """random order of users in which every prefix holds each activity quantile in proportion."""
+    if len(activity) == 0:
+        return np.zeros(0, dtype=np.int64)
+    edges = np.quantile(activity, np.linspace(0, 1, num_strata + 1)[1:-1])
+    strata = np.searchsorted(edges, activity, side="right")
+    shuffled = rng.permutation(len(activity))
+    sorted_positions = shuffled[np.argsort(strata[shuffled], kind="stable")]
+    stratum_sizes = np.bincount(strata, minlength=num_strata)
+    stratum_starts = np.concatenate([[0], np.cumsum(stratum_sizes)[:-1]])
+    sorted_strata = strata[sorted_positions]
+    rank_in_stratum = np.arange(len(activity)) - stratum_starts[sorted_strata]
+    # spread each stratum evenly over the order; ties between strata are broken at random
+    position = (rank_in_stratum + rng.random(len(activity))) / stratum_sizes[sorted_strata]
+    return np.asarray(sorted_positions[np.argsort(position, kind="stable")])
+
+
+class RankingAccumulator(object):
+    """
+    Precision@k and recall@k summed over users evaluated shard by shard, so finished shards of top k lists can be
+    evaluated while later ones are still scored. Each user of true_user2items counts once; add is thread safe.
+    """
+
+    def __init__(
+        self,
+        true_user2items: Dict[int, List[int]],
+        k: int,
+    ):
+        if k < 1:
+            raise ValueError
+        self.true_user2items = true_user2items
+        self.k = k
+        self.evaluated: Set[int] = set()
+        self.precision_sum = 0.0
+        self.recall_sum = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, pred_user2items: Dict[int, List[int]]):
+        with self._lock:
+            user_ids = [
+                user_id
+                for user_id in pred_user2items
+                if user_id in self.true_user2items and user_id not in self.evaluated
+            ]
+            self.evaluated.update(user_ids)
+        hits, true_lengths = _hits_per_user(self.true_user2items, pred_user2items, user_ids, self.k)
+        with self._lock:
+            self.precision_sum += float((hits / self.k).sum())
+            self.recall_sum += float((hits / np.maximum(true_lengths, 1)).sum())
+
+    def remaining(self) -> List[int]:
+        """users of true_user2items not evaluated yet."""
+        return [user_id for user_id in self.true_user2items if user_id not in self.evaluated]
+
+    def precision_at_k(self) -> PrecisionAtK:
+        return PrecisionAtK(precision=self.precision_sum / max(len(self.true_user2items), 1), k=self.k)
+
+    def recall_at_k(self) -> RecallAtK:
+        return RecallAtK(recall=self.recall_sum / max(len(self.true_user2items), 1), k=self.k)
+
+
 class MetricCalculator(object):
     def __init__(self):
         self.logger = configure_logger(__name__)
@@ -112,7 +244,7 @@ class MetricCalculator(object):
         for user_id in true_user2items.keys():
             r_at_k = self.recall_at_k(
                 true_items=true_user2items[user_id],
-                pred_items=pred_user2items[user_id],
+                pred_items=pred_user2items.get(user_id, []),
                 k=k,
             )
             scores.append(r_at_k)
@@ -130,8 +262,110 @@ class MetricCalculator(object):
         for user_id in true_user2items.keys():
             p_at_k = self.precision_at_k(
                 true_items=true_user2items[user_id],
-                pred_items=pred_user2items[user_id],
+                pred_items=pred_user2items.get(user_id, []),
                 k=k,
             )
             scores.append(p_at_k)
         return float(np.mean(scores))
+
+    def calculate_sampled(
+        self,
+        true_rating: List[float],
+        pred_rating: List[float],
+        rating_user_ids: List[int],
+        true_user2items: Dict[int, List[int]],
+        pred_user2items: Dict[int, List[int]],
+        k: int,
+        evaluation: SampledEvaluation,
+        user_activity: Optional[Dict[int, int]] = None,
+    ) -> SampledMetrics:
+        """
+        Metrics of a stratified user sample with bootstrap confidence intervals.
+        Users are sampled from everyone with a test rating or a true item list. RMSE is pooled over all test ratings
+        of the sampled users; precision and recall are means over the sampled users that have a true item list.
+        user_activity (e.g. number of training ratings) defines the strata; without it users are sampled uniformly.
+        """
+        if k < 1:
+            raise ValueError
+        rng = np.random.default_rng(evaluation.seed)
+        ranked_user_ids = np.array(list(true_user2items.keys()), dtype=np.int64)
+        user_ids = np.union1d(ranked_user_ids, np.asarray(rating_user_ids, dtype=np.int64))
+        activity = np.array([(user_activity or {}).get(user_id, 0) for user_id in user_ids.tolist()])
+        order = user_ids[_stratified_order(activity, evaluation.num_strata, rng)]
+        sample_size = min(evaluation.sample_size or len(order), len(order))
+
+        # squared error sums and rating counts per user, for all users at once; user_ids is sorted
+        rating_users = np.searchsorted(user_ids, np.asarray(rating_user_ids, dtype=np.int64))
+        squared_errors = (np.asarray(true_rating, dtype=np.float64) - np.asarray(pred_rating, dtype=np.float64)) ** 2
+        user_squared_errors = np.bincount(rating_users, squared_errors, minlength=len(user_ids))
+        user_num_ratings = np.bincount(rating_users, minlength=len(user_ids)).astype(np.float64)
+
+        # running sums of numerators / denominators of (rmse^2, precision, recall), unweighted and per replicate
+        totals = np.zeros((3, 2))
+        replicate_numerators = np.zeros((3, evaluation.num_bootstrap))
+        replicate_denominators = np.zeros((3, evaluation.num_bootstrap))
+        alpha = (1 - evaluation.confidence) / 2
+        lows = highs = np.full(3, np.nan)
+        expected = np.array([len(rating_user_ids) > 0, len(ranked_user_ids) > 0, len(ranked_user_ids) > 0])
+        num_sampled = 0
+        while num_sampled < sample_size:
+            batch = order[num_sampled : min(num_sampled + evaluation.batch_size, sample_size)]
+            ranked = np.isin(batch, ranked_user_ids)
+            hits = np.zeros(len(batch))
+            true_lengths = np.ones(len(batch))
+            hits[ranked], true_lengths[ranked] = _hits_per_user(
+                true_user2items, pred_user2items, batch[ranked].tolist(), k
+            )
+            positions = np.searchsorted(user_ids, batch)
+            numerators = np.stack([user_squared_errors[positions], hits / k, hits / np.maximum(true_lengths, 1)])
+            denominators = np.stack([user_num_ratings[positions], ranked, ranked]).astype(np.float64)
+            num_sampled += len(batch)
+
+            # poisson bootstrap: each sampled user gets an independent Poisson(1) weight per replicate,
+            # so replicates are updated with the new batch only
+            weights = rng.poisson(1.0, (evaluation.num_bootstrap, len(batch))).astype(np.float64)
+            totals += np.stack([numerators.sum(axis=1), denominators.sum(axis=1)], axis=1)
+            replicate_numerators += numerators @ weights.T
+            replicate_denominators += denominators @ weights.T
+
+            estimates = np.where(
+                replicate_denominators > 0,
+                replicate_numerators / np.maximum(replicate_denominators, 1e-12),
+                np.nan,
+            )
+            estimates[0] = np.sqrt(estimates[0])
+            # replicates that drew no contributing user are dropped from the quantiles; stopping waits until every
+            # metric someone in the population contributes to has an interval
+            defined = ~np.isnan(estimates).all(axis=1)
+            lows, highs = np.full(3, np.nan), np.full(3, np.nan)
+            lows[defined], highs[defined] = np.nanquantile(estimates[defined], [alpha, 1 - alpha], axis=1)
+            widths = highs - lows
+            self.logger.info(f"evaluated {num_sampled} users, confidence interval widths {np.round(widths, 4)}")
+            if (
+                evaluation.max_ci_width is not None
+                and defined[expected].all()
+                and np.all(widths[expected] <= evaluation.max_ci_width)
+            ):
+                break
+
+        # a metric nobody in the sample contributes to (no ratings, no true items) is undefined
+        point = np.where(totals[:, 1] > 0, totals[:, 0] / np.maximum(totals[:, 1], 1e-12), np.nan)
+        intervals = [ConfidenceInterval(low=float(low), high=float(high)) for low, high in zip(lows, highs)]
+        return SampledMetrics(
+            metrics=Metrics(
+                rmse=float(np.sqrt(point[0])),
+                precision_at_k=PrecisionAtK(
+                    precision=float(point[1]),
+                    k=k,
+                ),
+                recall_at_k=RecallAtK(
+                    recall=float(point[2]),
+                    k=k,
+                ),
+            ),
+            rmse_ci=intervals[0],
+            precision_ci=intervals[1],
+            recall_ci=intervals[2],
+            num_sampled_users=num_sampled,
+            num_users=len(user_ids),
+        )
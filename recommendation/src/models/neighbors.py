@@ -0,0 +1,97 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+
+def _top_n_block(
+    normalized: sparse.csr_matrix,
+    transposed: sparse.csc_matrix,
+    start: int,
+    stop: int,
+    num_neighbors: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    similarity = (normalized[start:stop] @ transposed).toarray()
+    similarity[np.arange(stop - start), np.arange(start, stop)] = 0
+
+    neighbors = np.argpartition(-similarity, num_neighbors - 1, axis=1)[:, :num_neighbors]
+    values = np.take_along_axis(similarity, neighbors, axis=1)
+    positive = values > 0
+    return values[positive], neighbors[positive], positive.sum(axis=1)
+
+
+def top_n_cosine_neighbors(
+    features: sparse.csr_matrix,
+    num_neighbors: int = 100,
+    block_size: int = 1024,
+    num_threads: Optional[int] = 1,
+) -> sparse.csr_matrix:
+    """
+    row x row cosine similarity keeping only the num_neighbors most similar rows of each row.
+    Similarities are computed block_size rows at a time so the full square matrix is never held;
+    blocks run on num_threads threads (None for every cpu).
+    """
+    normalized = normalize(sparse.csr_matrix(features, dtype=np.float32), norm="l2")
+    transposed = normalized.T.tocsc()
+    num_rows = normalized.shape[0]
+    num_neighbors = max(min(num_neighbors, num_rows - 1), 1)
+
+    with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) as executor:
+        blocks = list(
+            executor.map(
+                lambda start: _top_n_block(
+                    normalized,
+                    transposed,
+                    start,
+                    min(start + block_size, num_rows),
+                    num_neighbors,
+                ),
+                range(0, num_rows, block_size),
+            )
+        )
+    data, indices, counts = zip(*blocks)
+
+    return sparse.csr_matrix(
+        (
+            np.concatenate(data),
+            np.concatenate(indices),
+            np.concatenate([[0], np.cumsum(np.concatenate(counts))]),
+        ),
+        shape=(num_rows, num_rows),
+    )
+
+
+def save_neighbors(
+    path: str,
+    neighbors: sparse.csr_matrix,
+    item_ids: np.ndarray,
+    key: str = "",
+):
+    """key identifies what the neighbors were built from, e.g. a ratings_fingerprint of the data and parameters."""
+    np.savez(
+        path,
+        data=neighbors.data,
+        indices=neighbors.indices,
+        indptr=neighbors.indptr,
+        shape=neighbors.shape,
+        item_ids=item_ids,
+        key=key,
+    )
+
+
+def load_neighbors(
+    path: str,
+    key: str = "",
+) -> Optional[Tuple[sparse.csr_matrix, np.ndarray]]:
+    """neighbors and item ids saved at path, or None when they were saved with another key."""
+    with np.load(path) as f:
+        if "key" not in f or str(f["key"]) != key:
+            return None
+        neighbors = sparse.csr_matrix(
+            (f["data"], f["indices"], f["indptr"]),
+            shape=tuple(f["shape"]),
+        )
+        return neighbors, f["item_ids"]
@@ -0,0 +1,193 @@
+import json
+import time
+from typing import Any, List
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+import pandas as pd
+from onnx import TensorProto, helper, numpy_helper
+from src.models.interactions import index_with_default
+from src.utils.logger import configure_logger
+
+logger = configure_logger(__name__)
+
+USER_IDS_KEY = "user_ids"
+MOVIE_IDS_KEY = "movie_ids"
+FEATURE_NAMES_KEY = "feature_names"
+
+
+def _add_tree_ensemble_attributes(node: onnx.NodeProto, forest: Any):
+    """
+    Write TreeEnsembleRegressor attributes equivalent to a fitted sklearn forest of regression trees into node, one
+    tree_ at a time. Thresholds and leaf values are float32 tensors (ai.onnx.ml opset 3) rather than repeated floats,
+    and every field is filled in place so neither the forest nor the model proto is copied as a whole.
+    """
+    node.attribute.extend(
+        [
+            helper.make_attribute("n_targets", 1),
+            helper.make_attribute("aggregate_function", "AVERAGE"),
+            helper.make_attribute("post_transform", "NONE"),
+        ]
+    )
+    names = [
+        "nodes_treeids",
+        "nodes_nodeids",
+        "nodes_featureids",
+        "nodes_modes",
+        "nodes_truenodeids",
+        "nodes_falsenodeids",
+        "target_ids",
+        "target_treeids",
+        "target_nodeids",
+    ]
+    types = {"nodes_modes": onnx.AttributeProto.STRINGS}
+    attributes = {name: node.attribute.add(name=name, type=types.get(name, onnx.AttributeProto.INTS)) for name in names}
+    thresholds, weights = [], []
+    for tree_id, estimator in enumerate(forest.estimators_):
+        tree = estimator.tree_
+        node_ids = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+        leaf_ids = node_ids[is_leaf].tolist()
+        attributes["nodes_treeids"].ints.extend([tree_id] * tree.node_count)
+        attributes["nodes_nodeids"].ints.extend(node_ids.tolist())
+        attributes["nodes_featureids"].ints.extend(np.where(is_leaf, 0, tree.feature).tolist())
+        attributes["nodes_modes"].strings.extend(np.where(is_leaf, b"LEAF", b"BRANCH_LEQ").tolist())
+        attributes["nodes_truenodeids"].ints.extend(np.where(is_leaf, 0, tree.children_left).tolist())
+        attributes["nodes_falsenodeids"].ints.extend(np.where(is_leaf, 0, tree.children_right).tolist())
+        attributes["target_ids"].ints.extend([0] * len(leaf_ids))
+        attributes["target_treeids"].ints.extend([tree_id] * len(leaf_ids))
+        attributes["target_nodeids"].ints.extend(leaf_ids)
+
+        # sklearn compares float32 inputs with float64 thresholds; round down so x <= t is unchanged
+        threshold = tree.threshold.astype(np.float32)
+        rounded_up = threshold.astype(np.float64) > tree.threshold
+        threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+        thresholds.append(np.where(is_leaf, 0, threshold).astype(np.float32))
+        weights.append(tree.value[is_leaf, 0, 0].astype(np.float32))
+
+    for name, values in [("nodes_values_as_tensor", thresholds), ("target_weights_as_tensor", weights)]:
+        attribute = node.attribute.add(name=name, type=onnx.AttributeProto.TENSOR)
+        attribute.t.CopyFrom(numpy_helper.from_array(np.concatenate(values), name=name))
+
+
+def export_regression(
+    forest: Any,
+    feature_names: List[str],
+    user_table: pd.DataFrame,
+    movie_table: pd.DataFrame,
+    default_value: float,
+    path: str,
+):
+    """
+    Export a fitted RandomForestRegressor with its feature layout.
+    user_table and movie_table are indexed by id with columns named after feature_names;
+    the graph takes user and movie row indexes, gathers and orders their features and runs the forest.
+    The last row of each table holds default_value for ids unseen in training.
+    """
+    user_table = user_table.sort_index()
+    movie_table = movie_table.sort_index()
+    user_columns = list(user_table.columns)
+    movie_columns = list(movie_table.columns)
+    columns = user_columns + movie_columns
+    permutation = np.array([columns.index(name) for name in feature_names], dtype=np.int64)
+
+    def with_default_row(table: pd.DataFrame) -> np.ndarray:
+        values = table.values.astype(np.float32)
+        default = np.where(table.columns.str.startswith("is_"), 0, default_value).astype(np.float32)
+        return np.vstack([values, default])
+
+    initializers = [
+        numpy_helper.from_array(with_default_row(user_table), name="user_table"),
+        numpy_helper.from_array(with_default_row(movie_table), name="movie_table"),
+        numpy_helper.from_array(permutation, name="permutation"),
+    ]
+    nodes = [
+        helper.make_node("Gather", ["user_table", "user_index"], ["user_features"], axis=0),
+        helper.make_node("Gather", ["movie_table", "movie_index"], ["movie_features"], axis=0),
+        helper.make_node("Concat", ["user_features", "movie_features"], ["all_features"], axis=1),
+        helper.make_node("Gather", ["all_features", "permutation"], ["features"], axis=1),
+        helper.make_node(
+            "TreeEnsembleRegressor",
+            ["features"],
+            ["variable"],
+            domain="ai.onnx.ml",
+        ),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "regression_recommendation",
+        inputs=[
+            helper.make_tensor_value_info("user_index", TensorProto.INT64, [None]),
+            helper.make_tensor_value_info("movie_index", TensorProto.INT64, [None]),
+        ],
+        outputs=[helper.make_tensor_value_info("variable", TensorProto.FLOAT, [None, 1])],
+        initializer=initializers,
+    )
+    model = helper.make_model(
+        graph,
+        opset_imports=[
+            helper.make_opsetid("", 13),
+            helper.make_opsetid("ai.onnx.ml", 3),
+        ],
+    )
+    helper.set_model_props(
+        model,
+        {
+            USER_IDS_KEY: json.dumps(user_table.index.tolist()),
+            MOVIE_IDS_KEY: json.dumps(movie_table.index.tolist()),
+            FEATURE_NAMES_KEY: json.dumps(feature_names),
+        },
+    )
+    # the forest is written last into the model's own node; onnxruntime validates the graph when it is loaded
+    _add_tree_ensemble_attributes(model.graph.node[-1], forest)
+    onnx.save(model, path)
+    logger.info(f"exported regression model: {path}")
+
+
+class OnnxRegressionEngine(object):
+    """float32 batch inference of an exported regression model; needs onnxruntime but not sklearn."""
+
+    def __init__(
+        self,
+        model_path: str,
+        num_threads: int = 1,
+    ):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            model_path,
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.user_ids = np.array(json.loads(metadata[USER_IDS_KEY]))
+        self.movie_ids = np.array(json.loads(metadata[MOVIE_IDS_KEY]))
+        self.feature_names: List[str] = json.loads(metadata[FEATURE_NAMES_KEY])
+        logger.info(f"initialized onnx regression engine: {model_path} with {num_threads} threads")
+
+    def predict(
+        self,
+        user_ids: np.ndarray,
+        movie_ids: np.ndarray,
+        batch_size: int = 65536,
+    ) -> np.ndarray:
+        start_time = time.perf_counter()
+        user_indexes = index_with_default(user_ids, self.user_ids)
+        movie_indexes = index_with_default(movie_ids, self.movie_ids)
+
+        predictions = np.empty(len(user_indexes), dtype=np.float32)
+        for start in range(0, len(user_indexes), batch_size):
+            stop = start + batch_size
+            predictions[start:stop] = self.session.run(
+                ["variable"],
+                {
+                    "user_index": user_indexes[start:stop],
+                    "movie_index": movie_indexes[start:stop],
+                },
+            )[0][:, 0]
+
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"onnx predicted {len(predictions)} rows: {len(predictions) / max(elapsed, 1e-9):.0f} rows/sec")
+        return predictions
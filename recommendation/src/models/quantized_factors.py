@@ -0,0 +1,172 @@
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+from src.models.topk import select_top_k
+
+
+class QuantizedFactors(object):
+    """
+    Factor matrix stored as int8 codes with one float32 scale per row around a float32 mean row:
+    row i ~= offset + codes[i] * scales[i]. Only the residual from the mean is quantized, so factors that share a
+    common direction (item2vec vectors mostly do) keep their differences; symmetric per-row quantization keeps
+    every residual's relative error near 1/254 whatever its norm, at a quarter of the float32 memory.
+    """
+
+    def __init__(
+        self,
+        codes: np.ndarray,
+        scales: np.ndarray,
+        offset: np.ndarray,
+    ):
+        self.codes = codes
+        self.scales = scales
+        self.offset = offset
+
+    @classmethod
+    def quantize(cls, factors: np.ndarray) -> "QuantizedFactors":
+        factors = np.asarray(factors, dtype=np.float32)
+        offset = factors.mean(axis=0)
+        residuals = factors - offset
+        scales = np.abs(residuals).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.clip(np.rint(residuals / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+        return cls(codes, scales.astype(np.float32), offset.astype(np.float32))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return (self.codes.shape[0], self.codes.shape[1])
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + self.scales.nbytes + self.offset.nbytes)
+
+    def scores(
+        self,
+        vectors: np.ndarray,
+        start: int = 0,
+        stop: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        approximate vectors @ factors[start:stop].T. numpy has no int8 GEMM, so the codes of those rows are widened
+        to float32 and the per-row scales applied to the product.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scores = vectors @ self.codes[start:stop].T.astype(np.float32)
+        scores *= self.scales[start:stop]
+        scores += (vectors @ self.offset)[:, np.newaxis]
+        return scores
+
+
+def quantized_top_k(
+    vectors: np.ndarray,
+    factors: QuantizedFactors,
+    exact_factors: np.ndarray,
+    k: int,
+    shortlist_size: int = 20,
+    exclude: Optional[sparse.spmatrix] = None,
+    mask: Optional[np.ndarray] = None,
+    bias: Optional[np.ndarray] = None,
+    block_size: int = 8192,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    top k of vectors @ exact_factors.T (+ bias) like select_top_k, in two stages: the int8 factors retrieve
+    shortlist_size candidates per row, then only those rows of exact_factors (may be a memmap) are re-ranked in float32.
+    The shortlist is merged one block of block_size factor rows at a time, so the approximate scores held at once
+    are rows x block_size, never rows x all factors.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    shortlist_size = max(shortlist_size, k)
+    exclude = exclude.tocsc() if exclude is not None else None
+    candidates = np.zeros((len(vectors), 0), dtype=np.int64)
+    candidate_scores = np.zeros((len(vectors), 0), dtype=np.float32)
+    for start in range(0, factors.shape[0], block_size):
+        stop = min(start + block_size, factors.shape[0])
+        approximate = factors.scores(vectors, start, stop)
+        if bias is not None:
+            approximate += bias[start:stop]
+        block_candidates, block_scores = select_top_k(
+            approximate,
+            k=shortlist_size,
+            exclude=exclude[:, start:stop] if exclude is not None else None,
+            mask=mask[start:stop] if mask is not None else None,
+        )
+        candidates = np.concatenate([candidates, block_candidates + start], axis=1)
+        candidate_scores = np.concatenate([candidate_scores, block_scores], axis=1)
+        if candidates.shape[1] > shortlist_size:
+            order, candidate_scores = select_top_k(candidate_scores, k=shortlist_size)
+            candidates = np.take_along_axis(candidates, order, axis=1)
+
+    exact = np.einsum("ud,usd->us", vectors, np.asarray(exact_factors[candidates], dtype=np.float32))
+    if bias is not None:
+        exact += bias[candidates]
+    # excluded and masked-out candidates only fill shortlists that ran out of items
+    exact[~np.isfinite(candidate_scores)] = -np.inf
+    order, top_scores = select_top_k(exact, k=k)
+    return np.take_along_axis(candidates, order, axis=1), top_scores
+
+
+@dataclass(frozen=True)
+class QuantizationBenchmark:
+    shortlist_size: int
+    recall: float
+    milliseconds_per_user: float
+    factor_bytes: int
+
+    def __str__(self) -> str:
+        return (
+            f"shortlist={self.shortlist_size}: recall@k={self.recall:.4f}, "
+            f"{self.milliseconds_per_user:.3f} ms/user, factors {self.factor_bytes / 1024 ** 2:.2f} MiB"
+        )
+
+
+def benchmark_quantized(
+    vectors: np.ndarray,
+    exact_factors: np.ndarray,
+    k: int = 10,
+    shortlist_sizes: Sequence[int] = (10, 20, 50, 100, 200),
+    bias: Optional[np.ndarray] = None,
+) -> List[QuantizationBenchmark]:
+    """
+    recall@k of quantized_top_k against the exact float32 top k, time per user and resident factor memory,
+    for every shortlist size. shortlist_size=0 is the exact float32 baseline itself.
+    """
+    exact_factors = np.asarray(exact_factors, dtype=np.float32)
+    started = time.perf_counter()
+    scores = vectors @ exact_factors.T
+    if bias is not None:
+        scores += bias
+    truth, _ = select_top_k(scores, k=k)
+    results = [
+        QuantizationBenchmark(
+            shortlist_size=0,
+            recall=1.0,
+            milliseconds_per_user=1000 * (time.perf_counter() - started) / max(len(vectors), 1),
+            factor_bytes=exact_factors.nbytes,
+        )
+    ]
+
+    factors = QuantizedFactors.quantize(exact_factors)
+    for shortlist_size in shortlist_sizes:
+        started = time.perf_counter()
+        indexes, _ = quantized_top_k(
+            vectors,
+            factors,
+            exact_factors,
+            k=k,
+            shortlist_size=shortlist_size,
+            bias=bias,
+        )
+        elapsed = time.perf_counter() - started
+        hits = sum(len(np.intersect1d(found, expected)) for found, expected in zip(indexes, truth))
+        results.append(
+            QuantizationBenchmark(
+                shortlist_size=shortlist_size,
+                recall=hits / max(truth.size, 1),
+                milliseconds_per_user=1000 * elapsed / max(len(vectors), 1),
+                factor_bytes=factors.nbytes,
+            )
+        )
+    return results
@@ -0,0 +1,209 @@
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from src.models.interactions import ratings_fingerprint
+
+
+class RecentInteractionStore(object):
+    """
+    Last `capacity` high-rated movies of every user, kept in fixed-size ring buffers.
+    Row i of `items` / `timestamps` is the ring of the user `user_ids[i]`; `counts[i]` is the number of
+    events ever written to it, so the next write goes to slot counts[i] % capacity.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 5,
+        min_rating: float = 4,
+        initial_users: int = 1024,
+    ):
+        self.capacity = capacity
+        self.min_rating = min_rating
+        self.num_users = 0
+        self.user_ids = np.zeros(initial_users, dtype=np.int64)
+        self.items = np.full((initial_users, capacity), -1, dtype=np.int64)
+        self.timestamps = np.zeros((initial_users, capacity), dtype=np.int64)
+        self.counts = np.zeros(initial_users, dtype=np.int64)
+        self._user_index = pd.Index(self.user_ids[:0])
+
+    @classmethod
+    def from_ratings(
+        cls,
+        ratings: pd.DataFrame,
+        capacity: int = 5,
+        min_rating: float = 4,
+    ) -> "RecentInteractionStore":
+        store = cls(
+            capacity=capacity,
+            min_rating=min_rating,
+            initial_users=max(ratings.user_id.nunique(), 1),
+        )
+        store.ingest(
+            user_ids=ratings.user_id.values,
+            movie_ids=ratings.movie_id.values,
+            ratings=ratings.rating.values,
+            timestamps=ratings.timestamp.values,
+        )
+        return store
+
+    def _rows(self, user_ids: np.ndarray) -> np.ndarray:
+        """rows of user_ids; -1 for unknown users."""
+        return np.asarray(self._user_index.get_indexer(user_ids), dtype=np.int64)
+
+    def _add_users(self, user_ids: np.ndarray):
+        num_users = self.num_users + len(user_ids)
+        if num_users > len(self.user_ids):
+            size = max(num_users, 2 * len(self.user_ids))
+            grow = size - len(self.user_ids)
+            self.user_ids = np.concatenate([self.user_ids, np.zeros(grow, dtype=np.int64)])
+            self.items = np.concatenate([self.items, np.full((grow, self.capacity), -1, dtype=np.int64)])
+            self.timestamps = np.concatenate([self.timestamps, np.zeros((grow, self.capacity), dtype=np.int64)])
+            self.counts = np.concatenate([self.counts, np.zeros(grow, dtype=np.int64)])
+        self.user_ids[self.num_users : num_users] = user_ids
+        self.num_users = num_users
+        self._user_index = pd.Index(self.user_ids[:num_users])
+
+    def ingest(
+        self,
+        user_ids: np.ndarray,
+        movie_ids: np.ndarray,
+        ratings: np.ndarray,
+        timestamps: np.ndarray,
+    ):
+        """
+        Append a batch of rating events. Events below min_rating are ignored.
+        Batches are expected in time order; events within a batch may come in any order.
+        """
+        high = np.asarray(ratings) >= self.min_rating
+        user_ids = np.asarray(user_ids, dtype=np.int64)[high]
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)[high]
+        timestamps = np.asarray(timestamps, dtype=np.int64)[high]
+        if len(user_ids) == 0:
+            return
+
+        rows = self._rows(user_ids)
+        if (rows < 0).any():
+            self._add_users(np.unique(user_ids[rows < 0]))
+            rows = self._rows(user_ids)
+
+        order = np.lexsort((timestamps, rows))
+        rows, movie_ids, timestamps = rows[order], movie_ids[order], timestamps[order]
+        batch_rows, first, batch_counts = np.unique(rows, return_index=True, return_counts=True)
+        rank = np.arange(len(rows)) - np.repeat(first, batch_counts)
+        from_last = np.repeat(batch_counts, batch_counts) - rank
+
+        # only the newest `capacity` events of each user survive, so the slots written below never collide
+        kept = from_last <= self.capacity
+        slots = (self.counts[rows[kept]] + rank[kept]) % self.capacity
+        self.items[rows[kept], slots] = movie_ids[kept]
+        self.timestamps[rows[kept], slots] = timestamps[kept]
+        self.counts[batch_rows] += batch_counts
+
+    def _ordered_slots(self, rows: np.ndarray) -> np.ndarray:
+        """slot indexes of each row from oldest to newest; slots not yet written come first."""
+        return (self.counts[rows, np.newaxis] + np.arange(self.capacity)) % self.capacity
+
+    def recent(self, user_id: int) -> np.ndarray:
+        """recent movie ids of user_id from oldest to newest; empty for unknown users."""
+        row = self._rows(np.array([user_id]))[0]
+        if row < 0:
+            return np.empty(0, dtype=np.int64)
+        items: np.ndarray = self.items[row, self._ordered_slots(np.array([row]))[0]]
+        return items[items >= 0]
+
+    def recent_matrix(
+        self,
+        user_ids: np.ndarray,
+        item_ids: np.ndarray,
+    ) -> sparse.csr_matrix:
+        """user x item CSR matrix of ones for the recent movies of user_ids; movies not in the sorted item_ids are dropped."""
+        rows = self._rows(user_ids)
+        known = rows >= 0
+        items = np.full((len(user_ids), self.capacity), -1, dtype=np.int64)
+        items[known] = self.items[rows[known, np.newaxis], self._ordered_slots(rows[known])]
+
+        user_indexes, slots = np.nonzero(items >= 0)
+        movie_ids = items[user_indexes, slots]
+        item_indexes = np.minimum(np.searchsorted(item_ids, movie_ids), max(len(item_ids) - 1, 0))
+        in_items = (len(item_ids) > 0) & (item_ids[item_indexes] == movie_ids)
+        return sparse.csr_matrix(
+            (
+                np.ones(in_items.sum(), dtype=np.float32),
+                (user_indexes[in_items], item_indexes[in_items]),
+            ),
+            shape=(len(user_ids), len(item_ids)),
+        )
+
+    def save(
+        self,
+        path: str,
+        key: str = "",
+    ):
+        """
+        snapshot the store; written to a temporary file first so a crash never leaves a partial snapshot.
+        key identifies what the store was built from, e.g. a ratings_fingerprint of the ratings and parameters.
+        """
+        temporary = f"{path}.tmp.npz"
+        np.savez(
+            temporary,
+            key=key,
+            capacity=self.capacity,
+            min_rating=self.min_rating,
+            user_ids=self.user_ids[: self.num_users],
+            items=self.items[: self.num_users],
+            timestamps=self.timestamps[: self.num_users],
+            counts=self.counts[: self.num_users],
+        )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        initial_users: Optional[int] = None,
+    ) -> "RecentInteractionStore":
+        with np.load(path) as f:
+            num_users = len(f["user_ids"])
+            store = cls(
+                capacity=int(f["capacity"]),
+                min_rating=float(f["min_rating"]),
+                initial_users=max(initial_users or num_users, num_users, 1),
+            )
+            store.user_ids[:num_users] = f["user_ids"]
+            store.items[:num_users] = f["items"]
+            store.timestamps[:num_users] = f["timestamps"]
+            store.counts[:num_users] = f["counts"]
+        store.num_users = num_users
+        store._user_index = pd.Index(store.user_ids[:num_users])
+        return store
+
+    @staticmethod
+    def saved_key(path: str) -> str:
+        with np.load(path) as f:
+            return str(f["key"]) if "key" in f else ""
+
+
+def load_or_build_store(
+    ratings: pd.DataFrame,
+    capacity: int = 5,
+    min_rating: float = 4,
+    path: Optional[str] = None,
+) -> RecentInteractionStore:
+    """
+    restore the snapshot at path if it was built from the same ratings, capacity and min_rating,
+    otherwise build the store from ratings and snapshot it to path, overwriting a stale one.
+    """
+    key = ratings_fingerprint(ratings, capacity, min_rating) if path is not None else ""
+    if path is not None and os.path.exists(path) and RecentInteractionStore.saved_key(path) == key:
+        return RecentInteractionStore.load(path)
+    store = RecentInteractionStore.from_ratings(
+        ratings,
+        capacity=capacity,
+        min_rating=min_rating,
+    )
+    if path is not None:
+        store.save(path, key)
+    return store
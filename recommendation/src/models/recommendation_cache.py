@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+CacheKey = Tuple[Hashable, int, int, Hashable]
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    invalidations: int
+    size: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class RecommendationCache(object):
+    """
+    Top-k lists keyed by (model version, user, k, filters), bounded to max_entries with LRU eviction.
+    Entries older than ttl_seconds are treated as misses. A user's entries are dropped by invalidate_users
+    when new ratings arrive, and a model version's entries by invalidate_model when its artifact changes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 100000,
+        ttl_seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries: "OrderedDict[CacheKey, Tuple[float, List[int]]]" = OrderedDict()
+        self._user_keys: Dict[int, Set[CacheKey]] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def _remove(self, key: CacheKey):
+        del self._entries[key]
+        user_keys = self._user_keys[key[1]]
+        user_keys.discard(key)
+        if not user_keys:
+            del self._user_keys[key[1]]
+
+    def get(
+        self,
+        model_version: Hashable,
+        user_id: int,
+        k: int,
+        filters: Hashable = (),
+    ) -> Optional[List[int]]:
+        key = (model_version, user_id, k, filters)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            stored_at, items = entry
+            if self.ttl_seconds is not None and self.clock() - stored_at > self.ttl_seconds:
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            # copies both ways, so callers never mutate a cached list
+            return list(items)
+
+    def put(
+        self,
+        model_version: Hashable,
+        user_id: int,
+        k: int,
+        items: List[int],
+        filters: Hashable = (),
+    ):
+        key = (model_version, user_id, k, filters)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (self.clock(), list(items))
+            self._user_keys.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate_users(self, user_ids: Iterable[int]):
+        """drop every cached list of user_ids, e.g. after new ratings of those users were ingested."""
+        with self._lock:
+            for user_id in user_ids:
+                for key in list(self._user_keys.get(user_id, ())):
+                    self._remove(key)
+                    self._invalidations += 1
+
+    def invalidate_model(self, model_version: Hashable):
+        """drop every cached list computed by model_version."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_version]:
+                self._remove(key)
+                self._invalidations += 1
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                expirations=self._expirations,
+                invalidations=self._invalidations,
+                size=len(self._entries),
+            )
@@ -0,0 +1,42 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+
+def select_top_k(
+    scores: np.ndarray,
+    k: int,
+    exclude: Optional[sparse.spmatrix] = None,
+    mask: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    top k column indexes and scores of every row, best first.
+    Cells stored in exclude (explicit zeros included) and columns where mask is False score -inf.
+    """
+    scores = np.array(scores, dtype=np.float32)
+    if exclude is not None:
+        exclude = exclude.tocoo()
+        scores[exclude.row, exclude.col] = -np.inf
+    if mask is not None:
+        scores[:, ~mask] = -np.inf
+    k = min(k, scores.shape[1])
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    return (
+        np.take_along_axis(candidates, order, axis=1),
+        np.take_along_axis(candidate_scores, order, axis=1),
+    )
+
+
+def to_user2items(
+    user_ids: np.ndarray,
+    item_ids: np.ndarray,
+    indexes: np.ndarray,
+    scores: np.ndarray,
+) -> Dict[int, List[int]]:
+    user2items: Dict[int, List[int]] = {}
+    for user_id, user_indexes, user_scores in zip(user_ids, indexes, scores):
+        user2items[int(user_id)] = item_ids[user_indexes[np.isfinite(user_scores)]].tolist()
+    return user2items
@@ -1,39 +1,283 @@
+import asyncio
+import hashlib
+import json
 import os
+import re
 import shutil
+import zipfile
+from typing import IO, Dict, List, Optional, Tuple
 
 import httpx
+from src.utils.logger import configure_logger
+from src.utils.rating_cache import RatingCacheWriter, cache_path
 from tqdm import tqdm
 
+logger = configure_logger(__name__)
+
 URL = "https://files.grouplens.org/datasets/movielens/ml-10m.zip"
+MEMBERS = ("movies.dat", "tags.dat", "ratings.dat")
+RANGE_SIZE = 8 * 1024 * 1024
+
+
+def _ranges(
+    total: int,
+    range_size: int,
+) -> List[Tuple[int, int]]:
+    return [(start, min(start + range_size, total) - 1) for start in range(0, total, range_size)]
+
+
+class Manifest(object):
+    """Completed byte ranges of a partial download, persisted next to the part file."""
+
+    def __init__(
+        self,
+        path: str,
+        url: str,
+        total: int,
+    ):
+        self.path = path
+        self.url = url
+        self.total = total
+        self.completed: List[Tuple[int, int]] = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            if manifest["url"] == url and manifest["total"] == total:
+                self.completed = [tuple(r) for r in manifest["completed"]]  # type: ignore
+
+    def add(self, byte_range: Tuple[int, int]):
+        """record a range whose bytes are already synced; a crash leaves either the old or the new manifest."""
+        self.completed.append(byte_range)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(
+                dict(
+                    url=self.url,
+                    total=self.total,
+                    completed=self.completed,
+                ),
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+
+async def _fetch_range(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    url: str,
+    fd: int,
+    byte_range: Tuple[int, int],
+    manifest: Manifest,
+    progress: tqdm,
+):
+    start, end = byte_range
+    async with semaphore:
+        async with client.stream(
+            method="GET",
+            url=url,
+            headers={"Range": f"bytes={start}-{end}"},
+        ) as response:
+            if response.status_code != httpx.codes.PARTIAL_CONTENT:
+                raise ValueError(f"server ignored range request {start}-{end}: {response.status_code}")
+            offset = start
+            async for chunk in response.aiter_bytes():
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                progress.update(len(chunk))
+    if offset != end + 1:
+        raise ValueError(f"incomplete range {start}-{end}: received up to {offset}")
+    os.fsync(fd)
+    manifest.add(byte_range)
+
+
+async def _download_ranges(
+    url: str,
+    part_file: str,
+    total: int,
+    num_connections: int,
+    range_size: int,
+):
+    manifest = Manifest(
+        path=f"{part_file}.manifest.json",
+        url=url,
+        total=total,
+    )
+    completed = set(manifest.completed)
+    pending = [r for r in _ranges(total, range_size) if r not in completed]
+    logger.info(f"download {len(pending)} ranges, {len(completed)} already completed")
+
+    mode = os.O_WRONLY if os.path.exists(part_file) and completed else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    fd = os.open(part_file, mode, 0o644)
+    try:
+        os.ftruncate(fd, total)
+        semaphore = asyncio.Semaphore(num_connections)
+        limits = httpx.Limits(max_connections=num_connections)
+        async with httpx.AsyncClient(limits=limits, timeout=60, follow_redirects=True) as client:
+            with tqdm(
+                total=total,
+                initial=sum(end - start + 1 for start, end in completed),
+                unit_scale=True,
+                unit_divisor=1024,
+                unit="B",
+            ) as progress:
+                tasks = [
+                    asyncio.ensure_future(_fetch_range(client, semaphore, url, fd, r, manifest, progress))
+                    for r in pending
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # stop the other ranges before the part file is closed; completed ones stay in the manifest
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+    finally:
+        os.close(fd)
+    os.remove(manifest.path)
 
 
-def download():
-    target_directory = os.getenv("TARGET_DIRECTORY", "data/")
-    target_file = os.path.join(target_directory, "ml-10m.zip")
+def _download_stream(
+    url: str,
+    part_file: str,
+):
+    with open(
+        file=part_file,
+        mode="wb",
+    ) as download_file:
+        with httpx.stream(
+            method="GET",
+            url=url,
+            follow_redirects=True,
+        ) as response:
+            total = int(response.headers["Content-Length"])
+            with tqdm(
+                total=total,
+                unit_scale=True,
+                unit_divisor=1024,
+                unit="B",
+            ) as progress:
+                downloaded_bytes = response.num_bytes_downloaded
+                for chunk in response.iter_bytes():
+                    download_file.write(chunk)
+                    progress.update(response.num_bytes_downloaded - downloaded_bytes)
+                    downloaded_bytes = response.num_bytes_downloaded
+
+
+def _expected_md5(
+    url: str,
+    md5: Optional[str],
+) -> Optional[str]:
+    if md5 is not None:
+        return md5
+    response = httpx.get(f"{url}.md5", follow_redirects=True)
+    if response.status_code != httpx.codes.OK:
+        logger.warning(f"no checksum published at {url}.md5; skip checksum verification")
+        return None
+    # BSD style "MD5 (ml-10m.zip) = <hash>" as grouplens publishes, or GNU md5sum "<hash>  ml-10m.zip"
+    matched = re.search(r"\b[0-9a-fA-F]{32}\b", response.text)
+    if matched is None:
+        raise ValueError(f"no md5 digest in {url}.md5: {response.text[:100]}")
+    return matched.group(0).lower()
+
+
+def _verify(
+    path: str,
+    total: int,
+    md5: Optional[str],
+):
+    size = os.path.getsize(path)
+    if size != total:
+        raise ValueError(f"{path} has {size} bytes, expected {total}")
+    if md5 is None:
+        return
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(RANGE_SIZE), b""):
+            digest.update(chunk)
+    if digest.hexdigest() != md5:
+        raise ValueError(f"{path} md5 {digest.hexdigest()} does not match {md5}")
+    logger.info(f"verified {path}: {size} bytes, md5 {md5}")
+
+
+def _copy_with_rating_cache(
+    source: IO[bytes],
+    destination: IO[bytes],
+    rating_cache: str,
+):
+    cache_writer = RatingCacheWriter(rating_cache)
+    for chunk in iter(lambda: source.read(RANGE_SIZE), b""):
+        destination.write(chunk)
+        cache_writer.write(chunk)
+    cache_writer.close()
+    logger.info(f"saved rating cache {rating_cache}")
+
+
+def extract(
+    target_file: str,
+    target_directory: str,
+    members: Tuple[str, ...] = MEMBERS,
+):
+    """
+    Stream only the needed members out of the archive.
+    ratings.dat is parsed while it is copied and also saved as the npz rating cache.
+    """
+    with zipfile.ZipFile(target_file) as archive:
+        infos: Dict[str, zipfile.ZipInfo] = {os.path.basename(info.filename): info for info in archive.infolist()}
+        for member in members:
+            info = infos[member]
+            output_path = os.path.join(target_directory, info.filename)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            logger.info(f"extract {info.filename}")
+            with archive.open(info) as source, open(output_path, "wb") as destination:
+                if member == "ratings.dat":
+                    _copy_with_rating_cache(source, destination, cache_path(output_path))
+                else:
+                    shutil.copyfileobj(source, destination, RANGE_SIZE)
+
+
+def download(
+    url: str = URL,
+    num_connections: int = 8,
+    range_size: int = RANGE_SIZE,
+    md5: Optional[str] = None,
+    target_directory: Optional[str] = None,
+):
+    directory = target_directory or os.getenv("TARGET_DIRECTORY") or "data/"
+    target_file = os.path.join(directory, os.path.basename(url))
+    part_file = f"{target_file}.part"
 
     if not os.path.exists(target_file):
-        with open(
-            file=target_file,
-            mode="wb",
-        ) as download_file:
-            with httpx.stream(
-                method="GET",
-                url=URL,
-            ) as response:
-                total = int(response.headers["Content-Length"])
-                with tqdm(
+        head = httpx.head(url, follow_redirects=True)
+        head.raise_for_status()
+        total = int(head.headers["Content-Length"])
+        if head.headers.get("Accept-Ranges") == "bytes":
+            # range requests go straight to where a redirecting mirror points
+            asyncio.run(
+                _download_ranges(
+                    url=str(head.url),
+                    part_file=part_file,
                     total=total,
-                    unit_scale=True,
-                    unit_divisor=1024,
-                    unit="B",
-                ) as progress:
-                    downloaded_bytes = response.num_bytes_downloaded
-                    for chunk in response.iter_bytes():
-                        download_file.write(chunk)
-                        progress.update(response.num_bytes_downloaded - downloaded_bytes)
-                        downloaded_bytes = response.num_bytes_downloaded
-
-    shutil.unpack_archive(
-        filename=target_file,
-        extract_dir=target_directory,
+                    num_connections=num_connections,
+                    range_size=range_size,
+                )
+            )
+        else:
+            logger.info("server does not accept range requests; download sequentially")
+            _download_stream(
+                url=url,
+                part_file=part_file,
+            )
+        _verify(
+            path=part_file,
+            total=total,
+            md5=_expected_md5(url, md5),
+        )
+        os.replace(part_file, target_file)
+
+    extract(
+        target_file=target_file,
+        target_directory=directory,
     )
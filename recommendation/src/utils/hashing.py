@@ -0,0 +1,62 @@
+from typing import List, Union
+
+import numpy as np
+
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        z = np.asarray(x, dtype=np.uint64) + _GOLDEN_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * _MIX_1
+        z = (z ^ (z >> np.uint64(27))) * _MIX_2
+        return z ^ (z >> np.uint64(31))
+
+
+def keyed_hash(seed: int, *keys: Union[int, np.ndarray]) -> np.ndarray:
+    """
+    Stateless 64 bit hash of (seed, *keys), elementwise over broadcast keys.
+    The same inputs give the same value in any process, order or chunking.
+    """
+    h = splitmix64(np.asarray(seed, dtype=np.uint64))
+    for key in keys:
+        h = splitmix64(h ^ np.asarray(key).astype(np.uint64))
+    return h
+
+
+def keyed_uniform(seed: int, *keys: Union[int, np.ndarray]) -> np.ndarray:
+    """uniform float64 in [0, 1) derived from keyed_hash."""
+    return (keyed_hash(seed, *keys) >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def keyed_sample(
+    seed: int,
+    key: int,
+    population: int,
+    k: int,
+    exclude: np.ndarray,
+) -> np.ndarray:
+    """
+    k distinct draws from range(population) that are not in exclude, derived from keyed_hash(seed, key, counter).
+    Candidates are drawn in rounds of 2k counters, so memory stays O(k + len(exclude)) for any population.
+    """
+    available = population - len(exclude)
+    if available < 2 * k:
+        # rejection sampling would need O(population) draws, so rank the few remaining items by their hash instead
+        remaining = np.setdiff1d(np.arange(population), exclude)
+        return np.asarray(remaining[np.argsort(keyed_hash(seed, key, remaining), kind="stable")[:k]])
+    chosen: List[int] = []
+    seen = set(exclude.tolist())
+    counter = 0
+    while len(chosen) < k:
+        counters = np.arange(counter, counter + 2 * k, dtype=np.uint64)
+        counter += 2 * k
+        for candidate in (keyed_hash(seed, key, counters) % np.uint64(population)).tolist():
+            if candidate not in seen:
+                seen.add(candidate)
+                chosen.append(candidate)
+                if len(chosen) == k:
+                    break
+    return np.array(chosen, dtype=np.int64)
@@ -0,0 +1,81 @@
+import os
+import re
+import resource
+import shutil
+import tempfile
+from typing import Optional, Tuple
+
+import numpy as np
+from src.utils.logger import configure_logger
+
+logger = configure_logger(__name__)
+
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_memory_size(size: str) -> int:
+    """'512M', '4G', '1.5g' or a plain number of bytes."""
+    matched = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)i?B?\s*", size.upper())
+    if matched is None:
+        raise ValueError(f"invalid memory size: {size}")
+    return int(float(matched.group(1)) * _UNITS[matched.group(2)])
+
+
+def peak_rss() -> int:
+    """peak resident set size of this process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget(object):
+    """
+    Sizes blocks of work to a memory limit and spills arrays that do not fit to memory-mapped temp files.
+    Without a limit every block covers all rows and nothing is spilled.
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = None,
+        block_fraction: float = 0.1,
+    ):
+        self.limit = limit
+        self.block_fraction = block_fraction
+        self.spill_directory: Optional[str] = None
+
+    def block_rows(
+        self,
+        bytes_per_row: int,
+        default: int,
+    ) -> int:
+        """rows per block so one block's working set stays within a fraction of the limit."""
+        if self.limit is None:
+            return max(default, 1)
+        rows = int(self.limit * self.block_fraction // max(bytes_per_row, 1))
+        return max(min(rows, default), 1)
+
+    def allocate(
+        self,
+        shape: Tuple[int, ...],
+        dtype: type,
+    ) -> np.ndarray:
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.limit is None or nbytes <= self.limit * self.block_fraction:
+            return np.empty(shape, dtype=dtype)
+        return self.spill(shape, dtype)
+
+    def spill(
+        self,
+        shape: Tuple[int, ...],
+        dtype: type,
+    ) -> np.memmap:
+        """memory-mapped temp file array whatever the limit; removed by close."""
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.spill_directory is None:
+            self.spill_directory = tempfile.mkdtemp(prefix="recommendation_spill_")
+        path = os.path.join(self.spill_directory, f"{len(os.listdir(self.spill_directory))}.mmap")
+        logger.info(f"spill {nbytes / 1024 ** 2:.1f} MiB array {shape} to {path}")
+        return np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+
+    def close(self):
+        if self.spill_directory is not None:
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+            self.spill_directory = None
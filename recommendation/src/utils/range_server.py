@@ -0,0 +1,204 @@
+import contextlib
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple, Type
+
+import httpx
+import numpy as np
+from src.utils.download import Manifest, download
+from src.utils.logger import configure_logger
+from src.utils.rating_cache import cache_path, load_ratings, parse_ratings
+
+logger = configure_logger(__name__)
+
+
+def _handler(
+    files: Dict[str, bytes],
+    accept_ranges: bool,
+    interrupt_after: Optional[int],
+    served_ranges: List[Tuple[int, int]],
+) -> Type[BaseHTTPRequestHandler]:
+    lock = threading.Lock()
+    interruptions: List[Tuple[int, int]] = []
+
+    class RangeRequestHandler(BaseHTTPRequestHandler):
+        """
+        Serves files by name, answering `Range: bytes=start-end` with 206 when accept_ranges.
+        /redirect/<name> answers 302 to /<name>, like a mirror.
+        Once interrupt_after ranges are served, the next range response, and only that one, is cut off halfway
+        like a dropped connection; every other range response is appended to served_ranges.
+        """
+
+        def _respond(self, send_body: bool):
+            if self.path.startswith("/redirect/"):
+                self.send_response(HTTPStatus.FOUND)
+                self.send_header("Location", self.path[len("/redirect") :])
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = files.get(self.path.lstrip("/"))
+            if body is None:
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+
+            matched = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+            interrupted = False
+            if accept_ranges and matched is not None:
+                start, end = int(matched.group(1)), min(int(matched.group(2)), len(body) - 1)
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+                body = body[start : end + 1]
+                with lock:
+                    interrupted = send_body and not interruptions and len(served_ranges) == interrupt_after
+                    if interrupted:
+                        interruptions.append((start, end))
+                    elif send_body:
+                        served_ranges.append((start, end))
+            else:
+                self.send_response(HTTPStatus.OK)
+            if accept_ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if interrupted:
+                self.wfile.write(body[: len(body) // 2])
+                self.close_connection = True
+            elif send_body:
+                self.wfile.write(body)
+
+        def do_HEAD(self):
+            self._respond(send_body=False)
+
+        def do_GET(self):
+            self._respond(send_body=True)
+
+        def log_message(self, format, *args):
+            pass
+
+    return RangeRequestHandler
+
+
+@contextlib.contextmanager
+def serve(
+    files: Dict[str, bytes],
+    accept_ranges: bool = True,
+    interrupt_after: Optional[int] = None,
+    served_ranges: Optional[List[Tuple[int, int]]] = None,
+) -> Iterator[str]:
+    """local stand-in for a download mirror serving files; yields its base url."""
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        _handler(files, accept_ranges, interrupt_after, served_ranges if served_ranges is not None else []),
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _sample_archive(num_ratings: int = 20000) -> bytes:
+    """a small ml-10m.zip look-alike with random ratings."""
+    rng = np.random.default_rng(0)
+    ratings = "".join(
+        f"{user_id}::{movie_id}::{rating}::{timestamp}\n"
+        for user_id, movie_id, rating, timestamp in zip(
+            np.sort(rng.integers(1, 500, num_ratings)),
+            rng.integers(1, 100, num_ratings),
+            rng.integers(1, 11, num_ratings) / 2,
+            rng.integers(10**9, 2 * 10**9, num_ratings),
+        )
+    )
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, mode="w", compression=zipfile.ZIP_DEFLATED) as f:
+        f.writestr("ml-10M100K/movies.dat", "".join(f"{i}::Movie {i} (1995)::Drama\n" for i in range(1, 100)))
+        f.writestr("ml-10M100K/tags.dat", "1::1::classic::1000000000\n")
+        f.writestr("ml-10M100K/ratings.dat", ratings)
+    return archive.getvalue()
+
+
+def _check_downloaded(
+    directory: str,
+    archive: bytes,
+    name: str,
+):
+    with open(os.path.join(directory, "ml-10m.zip"), "rb") as f:
+        if f.read() != archive:
+            raise ValueError(f"downloaded archive differs ({name})")
+    with zipfile.ZipFile(io.BytesIO(archive)) as f:
+        expected_ratings = parse_ratings(f.read("ml-10M100K/ratings.dat"))
+    ratings = load_ratings(cache_path(os.path.join(directory, "ml-10M100K", "ratings.dat")))
+    if not ratings.equals(expected_ratings):
+        raise ValueError(f"rating cache differs from ratings.dat ({name})")
+    logger.info(f"download check passed ({name}, {len(archive)} bytes)")
+
+
+def _check_resumed_download(
+    files: Dict[str, bytes],
+    num_connections: int,
+    range_size: int,
+    interrupt_after: int = 3,
+):
+    """the connection drops after interrupt_after ranges; the next run fetches only ranges missing from the manifest."""
+    archive = files["ml-10m.zip"]
+    num_ranges = -(-len(archive) // range_size)
+    served_ranges: List[Tuple[int, int]] = []
+    with serve(
+        files, interrupt_after=interrupt_after, served_ranges=served_ranges
+    ) as base_url, tempfile.TemporaryDirectory() as directory:
+        url = f"{base_url}/redirect/ml-10m.zip"
+        try:
+            download(url=url, num_connections=num_connections, range_size=range_size, target_directory=directory)
+        except httpx.TransportError as e:
+            logger.info(f"download interrupted as expected: {e!r}")
+        else:
+            raise ValueError("download was not interrupted")
+
+        manifest = Manifest(
+            path=os.path.join(directory, "ml-10m.zip.part.manifest.json"),
+            url=f"{base_url}/ml-10m.zip",
+            total=len(archive),
+        )
+        completed = set(manifest.completed)
+        if not interrupt_after <= len(completed) < num_ranges:
+            raise ValueError(f"manifest has {len(completed)} of {num_ranges} ranges after the interruption")
+
+        num_served = len(served_ranges)
+        download(url=url, num_connections=num_connections, range_size=range_size, target_directory=directory)
+        resumed = set(served_ranges[num_served:])
+        if resumed & completed or len(resumed) < num_ranges - len(completed):
+            raise ValueError(f"resume fetched {len(resumed)} ranges, {len(resumed & completed)} of them already done")
+        if os.path.exists(manifest.path):
+            raise ValueError("manifest left behind after the resumed download")
+        _check_downloaded(directory, archive, f"resumed after {len(completed)} of {num_ranges} ranges")
+
+
+def check_download(num_connections: int = 4):
+    """
+    Download a sample archive from a local stand-in server through a redirect, once with range requests and once
+    from a server without them, checking the GNU md5sum checksum, the extracted members and the rating cache.
+    Then interrupt a range download partway and check that the next run resumes from its manifest.
+    """
+    archive = _sample_archive()
+    digest = hashlib.md5(archive).hexdigest()
+    files = {"ml-10m.zip": archive, "ml-10m.zip.md5": f"{digest}  ml-10m.zip\n".encode()}
+
+    for accept_ranges in [True, False]:
+        with serve(files, accept_ranges=accept_ranges) as base_url, tempfile.TemporaryDirectory() as directory:
+            download(
+                url=f"{base_url}/redirect/ml-10m.zip",
+                num_connections=num_connections,
+                range_size=4096,
+                target_directory=directory,
+            )
+            _check_downloaded(directory, archive, f"accept_ranges={accept_ranges}")
+    _check_resumed_download(files, num_connections=num_connections, range_size=4096)
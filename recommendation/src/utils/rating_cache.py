@@ -0,0 +1,99 @@
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import IO, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+RATING_DTYPES = {
+    "user_id": np.int32,
+    "movie_id": np.int32,
+    "rating": np.float32,
+    "timestamp": np.int32,
+}
+
+
+def cache_path(rating_path: str) -> str:
+    return f"{os.path.splitext(rating_path)[0]}.npz"
+
+
+def parse_ratings(data: bytes) -> pd.DataFrame:
+    """parse complete user_id::movie_id::rating::timestamp lines with the C parser."""
+    return pd.read_csv(
+        io.BytesIO(data.replace(b"::", b"\t")),
+        sep="\t",
+        names=list(RATING_DTYPES.keys()),
+        dtype=RATING_DTYPES,
+        engine="c",
+    )
+
+
+def load_ratings(
+    path: str,
+    num_users: Optional[int] = None,
+) -> pd.DataFrame:
+    """ratings of the num_users smallest user ids; columns are loaded one at a time and filtered."""
+    with np.load(path) as f:
+        user_ids = f["user_id"]
+        if num_users is None:
+            selected = slice(None)
+        else:
+            selected = user_ids <= np.unique(user_ids)[:num_users].max()
+        return pd.DataFrame({column: f[column][selected] for column in RATING_DTYPES.keys()})
+
+
+class RatingCacheWriter(object):
+    """
+    Parse a ratings.dat byte stream chunk by chunk and save the columns as npz.
+    Parsed columns are appended to raw files next to path and the npz members are streamed from them on close,
+    so no more than one chunk is held in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.remainder = b""
+        self.num_rows = 0
+        self.directory = tempfile.mkdtemp(prefix="rating_cache_", dir=os.path.dirname(path) or None)
+        self.columns: Dict[str, IO[bytes]] = {
+            column: open(os.path.join(self.directory, column), "wb") for column in RATING_DTYPES
+        }
+
+    def _append(self, ratings: pd.DataFrame):
+        for column, dtype in RATING_DTYPES.items():
+            self.columns[column].write(ratings[column].values.astype(dtype).tobytes())
+        self.num_rows += len(ratings)
+
+    def write(self, data: bytes):
+        data = self.remainder + data
+        end = data.rfind(b"\n") + 1
+        self.remainder = data[end:]
+        if end > 0:
+            self._append(parse_ratings(data[:end]))
+
+    def close(self):
+        if self.remainder.strip():
+            self._append(parse_ratings(self.remainder))
+        self.remainder = b""
+        for column_file in self.columns.values():
+            column_file.close()
+
+        # the same layout np.savez writes: one uncompressed .npy member per column
+        temporary = f"{self.path}.tmp"
+        with zipfile.ZipFile(temporary, mode="w", allowZip64=True) as archive:
+            for column, dtype in RATING_DTYPES.items():
+                with archive.open(f"{column}.npy", mode="w", force_zip64=True) as member:
+                    np.lib.format.write_array_header_1_0(
+                        member,
+                        {
+                            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                            "fortran_order": False,
+                            "shape": (self.num_rows,),
+                        },
+                    )
+                    with open(os.path.join(self.directory, column), "rb") as column_file:
+                        shutil.copyfileobj(column_file, member, 8 * 1024 * 1024)
+        os.replace(temporary, self.path)
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,12 +1,74 @@
+import itertools
 import os
-from random import random
+from enum import Enum
+from multiprocessing import Pool
+from typing import List, Optional, Tuple
 
+from src.utils.hashing import keyed_uniform
 from src.utils.logger import configure_logger
+from src.utils.rating_cache import parse_ratings
 
 logger = configure_logger(__name__)
 
+CHUNK_SIZE = 32 * 1024 * 1024
 
-def make_small_ratings(rate: float = 0.1):
+
+class SamplingMode(Enum):
+    ROW = "row"
+    USER = "user"
+    ITEM = "item"
+
+
+def _chunk_ranges(
+    path: str,
+    chunk_size: int,
+) -> List[Tuple[int, int]]:
+    """byte ranges of about chunk_size that start and end on line boundaries."""
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _sample_chunk(args: Tuple[str, int, int, float, str, int]) -> bytes:
+    path, start, end, rate, mode, seed = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        lines = [line for line in f.read(end - start).split(b"\n") if line.strip()]
+    if not lines:
+        return b""
+
+    ratings = parse_ratings(b"\n".join(lines))
+    if mode == SamplingMode.USER.value:
+        keys = [ratings.user_id.values]
+    elif mode == SamplingMode.ITEM.value:
+        keys = [ratings.movie_id.values]
+    else:
+        keys = [ratings.user_id.values, ratings.movie_id.values, ratings.timestamp.values]
+    selected = keyed_uniform(seed, *keys) < rate
+    return b"".join(line + b"\n" for line in itertools.compress(lines, selected))
+
+
+def make_small_ratings(
+    rate: float = 0.1,
+    mode: str = SamplingMode.ROW.value,
+    seed: int = 0,
+    num_processes: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Sample ratings.dat chunk by chunk on a process pool.
+    A rating is kept when a hash of (seed, key) falls below rate; the key is the rating itself for row,
+    the user id for user (whole histories) and the movie id for item sampling,
+    so the result depends only on the seed and never on chunking or process count.
+    """
     target_directory = os.getenv("TARGET_DIRECTORY", "data/ml-10M100K")
     original_file = os.path.join(target_directory, "ratings.dat")
     target_file = os.path.join(target_directory, f"small_rating_{rate}.dat")
@@ -14,19 +76,19 @@ def make_small_ratings(rate: float = 0.1):
         f"""
 make small rating file:
     rate: {rate}
+    mode: {mode}
+    seed: {seed}
     output file: {target_file}
     """
     )
 
-    with open(original_file, "r") as f:
-        lines = f.readlines()
-
-    selected = []
-    for l in lines:
-        if random() < rate:
-            selected.append(l)
-
-    with open(target_file, "w") as f:
-        f.write("".join(selected))
+    SamplingMode(mode)
+    tasks = [(original_file, start, end, rate, mode, seed) for start, end in _chunk_ranges(original_file, chunk_size)]
+    temporary_file = f"{target_file}.tmp"
+    with Pool(processes=num_processes) as pool, open(temporary_file, "wb") as f:
+        for i, selected in enumerate(pool.imap(_sample_chunk, tasks)):
+            f.write(selected)
+            logger.info(f"sampled chunk {i + 1}/{len(tasks)}")
+    os.replace(temporary_file, target_file)
 
     logger.info("done")
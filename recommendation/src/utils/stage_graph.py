@@ -0,0 +1,133 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from src.utils.logger import configure_logger
+
+logger = configure_logger(__name__)
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    function: Callable[..., Any]
+    inputs: Tuple[str, ...] = ()
+    process: bool = False
+
+
+@dataclass(frozen=True)
+class StageTiming:
+    """start and end of a stage in seconds since the graph started."""
+
+    name: str
+    start: float
+    end: float
+
+    @property
+    def seconds(self) -> float:
+        return self.end - self.start
+
+
+def _timed(
+    function: Callable[..., Any],
+    *args: Any,
+) -> Tuple[float, float, Any]:
+    # wall clock rather than perf_counter, so timings taken in worker processes are comparable
+    start = time.time()
+    result = function(*args)
+    return start, time.time(), result
+
+
+class StageGraph(object):
+    """
+    Named stages, each called with the results of its inputs as soon as all of them are done.
+    Independent stages overlap on a pool of num_workers threads, or on a process pool for stages added with
+    process=True (their function, inputs and result must pickle). With num_workers=1 every stage runs in the
+    calling thread in the order it was added. A stage can only depend on stages added before it, so the graph
+    never has a cycle.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 1,
+        num_processes: int = 1,
+    ):
+        self.num_workers = num_workers
+        self.num_processes = num_processes
+        self.stages: Dict[str, Stage] = {}
+        self.timings: List[StageTiming] = []
+
+    def add(
+        self,
+        name: str,
+        function: Callable[..., Any],
+        inputs: Sequence[str] = (),
+        process: bool = False,
+    ) -> "StageGraph":
+        if name in self.stages:
+            raise ValueError(f"stage {name} is already defined")
+        unknown = [input_name for input_name in inputs if input_name not in self.stages]
+        if unknown:
+            raise ValueError(f"stage {name} depends on undefined stages {unknown}")
+        self.stages[name] = Stage(
+            name=name,
+            function=function,
+            inputs=tuple(inputs),
+            process=process,
+        )
+        return self
+
+    def run(self) -> Dict[str, Any]:
+        """results of every stage by name."""
+        started = time.time()
+        results: Dict[str, Any] = {}
+        self.timings = []
+        if self.num_workers <= 1:
+            for stage in self.stages.values():
+                start, end, results[stage.name] = _timed(stage.function, *[results[name] for name in stage.inputs])
+                self.timings.append(StageTiming(stage.name, start - started, end - started))
+            return results
+
+        remaining = dict(self.stages)
+        pending: Dict[Future, str] = {}
+        processes: Optional[ProcessPoolExecutor] = None
+        if any(stage.process for stage in self.stages.values()):
+            processes = ProcessPoolExecutor(max_workers=self.num_processes)
+        threads = ThreadPoolExecutor(max_workers=self.num_workers)
+        try:
+            while remaining or pending:
+                for stage in list(remaining.values()):
+                    if all(name in results for name in stage.inputs):
+                        executor = processes if stage.process and processes is not None else threads
+                        future = executor.submit(_timed, stage.function, *[results[name] for name in stage.inputs])
+                        pending[future] = stage.name
+                        del remaining[stage.name]
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    start, end, results[name] = future.result()
+                    self.timings.append(StageTiming(name, start - started, end - started))
+        finally:
+            threads.shutdown(cancel_futures=True)
+            if processes is not None:
+                processes.shutdown(cancel_futures=True)
+        return results
+
+    def critical_path_seconds(self) -> float:
+        """longest chain of dependent stage durations of the last run; the wall time cannot go below it."""
+        seconds = {timing.name: timing.seconds for timing in self.timings}
+        finish: Dict[str, float] = {}
+        for stage in self.stages.values():
+            finish[stage.name] = max((finish[name] for name in stage.inputs), default=0) + seconds.get(stage.name, 0)
+        return max(finish.values(), default=0)
+
+    def log_timings(self, name: str):
+        for timing in sorted(self.timings, key=lambda timing: timing.start):
+            logger.info(f"{name} stage {timing.name}: {1000 * timing.start:.0f}-{1000 * timing.end:.0f} ms")
+        wall = max((timing.end for timing in self.timings), default=0)
+        total = sum(timing.seconds for timing in self.timings)
+        logger.info(
+            f"{name}: {1000 * wall:.0f} ms wall, {1000 * total:.0f} ms of stages, "
+            f"{1000 * self.critical_path_seconds():.0f} ms critical path on {self.num_workers} workers"
+        )
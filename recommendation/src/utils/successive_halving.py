@@ -0,0 +1,165 @@
+import dataclasses
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+from src.algorithms.registry import get_algorithm
+from src.models.dataset import DataLoader
+from src.utils.logger import configure_logger
+
+if TYPE_CHECKING:
+    from src.models.dataset import Dataset
+    from src.models.metrics import Metrics
+
+logger = configure_logger(__name__)
+
+METRICS: Dict[str, Tuple[Callable[["Metrics"], float], bool]] = {
+    # metric name -> (value of Metrics, larger is better)
+    "rmse": (lambda metrics: metrics.rmse, False),
+    "precision": (lambda metrics: metrics.precision_at_k.precision, True),
+    "recall": (lambda metrics: metrics.recall_at_k.recall, True),
+}
+
+# "split": the largest rung's split, loaded once by the parent and handed to every worker by _init_worker
+_worker_state: Dict[str, "Dataset"] = {}
+
+
+@dataclass(frozen=True)
+class Trial:
+    params: Dict[str, Any]
+    num_users: int
+    metrics: "Metrics"
+
+
+def parse_grid(params: List[str]) -> List[Dict[str, Any]]:
+    """["min_support=0.05,0.1", "min_threshold=1,2"] -> every combination; values are parsed as int, float or str."""
+
+    def parse_value(value: str) -> Any:
+        for parse in (int, float):
+            try:
+                return parse(value)
+            except ValueError:
+                pass
+        return None if value == "None" else value
+
+    names, values = [], []
+    for param in params:
+        name, _, choices = param.partition("=")
+        names.append(name)
+        values.append([parse_value(choice) for choice in choices.split(",")])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def _init_worker(split: "Dataset"):
+    _worker_state["split"] = split
+
+
+def _run_trial(
+    algorithm: str,
+    data_path: str,
+    num_users: int,
+    num_test_items: int,
+    k: int,
+    params: Dict[str, Any],
+) -> Trial:
+    recommender = get_algorithm(algorithm).load()(
+        num_users=num_users,
+        num_test_items=num_test_items,
+        data_path=data_path,
+    )
+    # smaller rungs are the smallest user ids of the largest one; recommenders write predictions into the test
+    # frame, so every trial gets its own copy
+    split = _worker_state["split"].head_users(num_users)
+    dataset = dataclasses.replace(split, test=split.test.copy())
+    metrics = recommender.evaluate(
+        dataset=dataset,
+        k=k,
+        top_k=k,
+        **params,
+    )
+    return Trial(
+        params=params,
+        num_users=num_users,
+        metrics=metrics,
+    )
+
+
+def successive_halving(
+    algorithm: str,
+    configurations: List[Dict[str, Any]],
+    metric: str = "precision",
+    min_users: int = 100,
+    max_users: int = 1000,
+    eta: int = 3,
+    num_workers: int = 1,
+    num_test_items: int = 5,
+    k: int = 10,
+    data_path: str = "data/ml-10M100K/",
+) -> List[Trial]:
+    """
+    Evaluate every configuration on the min_users subset, keep the best 1/eta and repeat on eta times more users
+    until max_users. The max_users split is loaded once and every rung takes its smallest user ids.
+    Returns the trials of the last rung, best first.
+    """
+    value, larger_is_better = METRICS[metric]
+    num_rungs = max(int(math.floor(math.log(max_users / min_users, eta))), 0) + 1
+    survivors = configurations
+    trials: List[Trial] = []
+    split = DataLoader(
+        num_users=max_users,
+        num_test_items=num_test_items,
+        data_path=data_path,
+    ).load()
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(split,)) as executor:
+        for rung in range(num_rungs):
+            num_users = max_users if rung == num_rungs - 1 else min_users * eta**rung
+            logger.info(f"rung {rung}: {len(survivors)} configurations on {num_users} users")
+            trials = list(
+                executor.map(
+                    _run_trial,
+                    itertools.repeat(algorithm),
+                    itertools.repeat(data_path),
+                    itertools.repeat(num_users),
+                    itertools.repeat(num_test_items),
+                    itertools.repeat(k),
+                    survivors,
+                )
+            )
+            trials.sort(key=lambda trial: value(trial.metrics), reverse=larger_is_better)
+            for trial in trials:
+                logger.info(f"{metric}={value(trial.metrics):.4f} {trial.params}")
+            survivors = [trial.params for trial in trials[: max(len(trials) // eta, 1)]]
+    return trials
+
+
+def search(
+    algorithm: str,
+    params: List[str],
+    metric: str = "precision",
+    min_users: int = 100,
+    max_users: int = 1000,
+    eta: int = 3,
+    num_workers: int = 1,
+    num_test_items: int = 5,
+    k: int = 10,
+    data_path: Optional[str] = None,
+) -> Trial:
+    configurations = parse_grid(params)
+    logger.info(f"search {len(configurations)} {algorithm} configurations by {metric}")
+    trials = successive_halving(
+        algorithm=algorithm,
+        configurations=configurations,
+        metric=metric,
+        min_users=min_users,
+        max_users=max_users,
+        eta=eta,
+        num_workers=num_workers,
+        num_test_items=num_test_items,
+        k=k,
+        data_path=data_path or "data/ml-10M100K/",
+    )
+    best = trials[0]
+    logger.info(f"best {algorithm} configuration on {best.num_users} users: {best.params}\n{best.metrics}")
+    return best